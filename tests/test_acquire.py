@@ -0,0 +1,36 @@
+import unittest
+
+from turbofloat import TurboFloat
+from turbofloat.c_wrapper import *
+from turbofloat.testing import FakeLibrary, install, uninstall
+
+_FOLDER = "test-acquire"
+
+
+class BackgroundAcquisitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = install(FakeLibrary(features={b"a": b"1"}), _FOLDER)
+
+    def tearDown(self):
+        uninstall(_FOLDER)
+
+    def test_read_raises_acquisition_error(self):
+        # No server was saved, so the acquisition fails.
+        tf = TurboFloat(b"x.dat", b"guid", _FOLDER, acquire=True)
+        self.assertRaises(TurboFloatNoServerError, tf.ready.result, 5)
+
+        self.assertRaises(TurboFloatNoServerError, tf.get_feature_value, b"a")
+        self.assertRaises(TurboFloatNoServerError, tf.get_feature_values, [b"a"])
+
+    def test_read_after_later_request(self):
+        tf = TurboFloat(b"x.dat", b"guid", _FOLDER, acquire=True)
+        self.assertRaises(TurboFloatNoServerError, tf.ready.result, 5)
+
+        tf.save_server(b"127.0.0.1", 13)
+        tf.request_lease()
+        self.assertEqual(tf.get_feature_value(b"a"), b"1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from turbofloat import LEASE_ACTIVE, LEASE_EXPIRED, TurboFloat
+from turbofloat.c_wrapper import *
+from turbofloat.testing import FakeLibrary, install, uninstall
+
+_FOLDER = "test-reconcile"
+
+
+class ReconcileLeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = install(FakeLibrary(features={b"a": b"1"}), _FOLDER)
+        self.tf = TurboFloat(b"x.dat", b"guid", _FOLDER)
+        self.tf.save_server(b"127.0.0.1", 13)
+        self.tf.set_callback(lambda status, context: None)
+
+    def tearDown(self):
+        uninstall(_FOLDER)
+
+    def test_lost_lease_invalidates_cache(self):
+        tf = self.tf
+        tf.request_lease()
+        gate = tf.gate(b"a")
+        self.assertEqual(tf.get_feature_value(b"a"), b"1")
+        self.assertTrue(gate.enabled)
+        generation = tf.feature_generation
+
+        # Lost without a callback.
+        self.lib._leases.clear()
+
+        self.assertFalse(tf.reconcile_lease())
+        self.assertEqual(tf.lease_state, LEASE_EXPIRED)
+        self.assertGreater(tf.feature_generation, generation)
+        self.assertRaises(TurboFloatNoLeaseError, tf.get_feature_value, b"a")
+        self.assertFalse(gate.enabled)
+
+    def test_found_lease_is_a_lease_event(self):
+        tf = self.tf
+        tf.request_lease()
+        self.lib._leases.clear()
+        tf.reconcile_lease()
+
+        self.lib.features = {b"a": b"2"}
+        self.lib._leases.add(tf._handle)
+
+        self.assertTrue(tf.reconcile_lease())
+        self.assertEqual(tf.lease_state, LEASE_ACTIVE)
+        self.assertEqual(tf.get_feature_value(b"a"), b"2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from turbofloat import TurboFloat, flight_recorder
+from turbofloat.c_wrapper import *
+from turbofloat.testing import FakeLibrary, install, uninstall
+
+_FOLDER = "test-recorder"
+
+
+class FlightRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = install(FakeLibrary(features={b"a": b"1"}), _FOLDER)
+        flight_recorder.clear()
+
+    def tearDown(self):
+        uninstall(_FOLDER)
+        flight_recorder.clear()
+
+    def test_lease_events_survive_date_checks(self):
+        tf = TurboFloat(b"x.dat", b"guid", _FOLDER)
+        tf.save_server(b"127.0.0.1", 13)
+        tf.set_callback(lambda status, context: None)
+        tf.request_lease()
+        self.lib.fire(TF_CB_FEATURES_CHANGED)
+
+        for _ in range(flight_recorder.size + 1000):
+            tf.is_date_valid(b"2000-01-01")
+            self.assertRaises(TurboFloatFailError, tf.get_feature_value, b"missing")
+
+        events = [event["event"] for event in flight_recorder.events()]
+        self.assertEqual(events, ["request_lease", "callback"])
+
+    def test_lease_errors_are_recorded(self):
+        tf = TurboFloat(b"x.dat", b"guid", _FOLDER)
+        tf.set_callback(lambda status, context: None)
+        self.assertRaises(TurboFloatNoServerError, tf.request_lease)
+
+        errors = [event for event in flight_recorder.events() if event["event"] == "error"]
+        self.assertEqual([event["detail"] for event in errors], ["TF_RequestLease"])
+
+
+if __name__ == "__main__":
+    unittest.main()
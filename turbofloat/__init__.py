@@ -22,44 +22,620 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from ctypes import pointer, sizeof, c_uint32
+import random
+import threading
+import time
+import traceback
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from contextlib import ContextDecorator
+from ctypes import byref, pointer, sizeof, c_uint32, c_ushort
+from datetime import datetime
+from functools import partial, wraps
+from itertools import count
+from weakref import WeakKeyDictionary
 
 from turbofloat.c_wrapper import *
+from turbofloat.c_wrapper import _ERRORS, _raise_error
+from turbofloat.snapshot import FeatureSnapshot, as_date, build_snapshot
+
+
+FeatureCacheInfo = namedtuple("FeatureCacheInfo", ["hits", "misses", "currsize"])
+
+LeaseAcquisition = namedtuple("LeaseAcquisition", ["attempts", "wait_time"])
+
+CallbackStats = namedtuple("CallbackStats", ["depth", "dispatched", "coalesced", "dropped",
+                                             "handler_calls", "handler_time", "handler_max_time"])
+
+"""
+The number of lease events that can wait for the callbacks to handle them
+before the oldest is dropped.
+"""
+CALLBACK_QUEUE_SIZE = 64
+
+# The errors acquire_lease() keeps retrying on; any other error is raised
+# straight away.
+_RETRY_ERRORS = (TurboFloatNoFreeLeaseError, TurboFloatConnectionError,
+                 TurboFloatConnectionTimeoutError)
+
+# Lease states, see TurboFloat.lease_state.
+
+"""No lease has been requested, or it was dropped."""
+LEASE_NONE = "none"
+
+"""The lease was acquired and hasn't been reported lost since."""
+LEASE_ACTIVE = "active"
+
+"""The lease expired and the library couldn't renew it."""
+LEASE_EXPIRED = "expired"
 
 #
-# Object oriented interface
+# Handle registry
 #
 
-class TurboFloat(object):
+_handles = {}
+_dat_files = set()
+_handles_lock = threading.Lock()
+
+# The library functions that take a handle as their first argument.
+_HANDLE_FUNCTIONS = ("TF_SaveServer", "TF_GetServer", "TF_SetLeaseCallbackEx", "TF_RequestLease",
+                     "TF_DropLease", "TF_HasLease", "TF_GetFeatureValue", "TF_IsDateValid")
+
+
+def _feature_value_error(result, args):
+    # The result is a size when no buffer is passed and an unchecked error
+    # code otherwise.
+    if args[-2] is not None and result != TF_OK:
+        error = _ERRORS.get(result, TurboFloatError)
+        return error.__name__
+
+
+# How metrics find the errors of functions that don't raise them.
+_RESULT_CHECKS = {
+    "TF_GetFeatureValue": _feature_value_error,
+}
+
+_now = time.perf_counter
+
+_EPOCH = datetime(1970, 1, 1)
+_DAY = 86400
+
+# How far the wall clock may drift from the monotonic clock between two
+# validate_dates() calls before the dates are validated again.
+_CLOCK_JUMP = 5.0
+
+
+class _SharedHandle(object):
+
+    """
+    The state of one TurboFloat handle. Every TurboFloat instance created for the
+    same library, dat file and GUID shares one of these, so the lease callback,
+    the feature cache and the library itself are only set up once.
+    """
+
+    def __init__(self, lib, handle):
+        self.lib = lib
+        self.handle = handle
+        self.lock = threading.Lock()
+
+        # Set by TurboFloat.enable_metrics().
+        self.metrics = None
+        self.bind_functions()
+
+        # TF_SetLeaseCallbackEx() is called once per handle with this
+        # trampoline, which forwards every status to each instance's callback.
+        self.trampoline = None
+        self.dispatcher = None
+        self.callbacks = WeakKeyDictionary()
+
+        # Feature values only change when the lease is (re)acquired, renewed
+        # with new fields or lost, so they are memoized between those events.
+        self.feature_cache = {}
+        self.feature_cache_hits = 0
+        self.feature_cache_misses = 0
+        self.feature_names = {}
+
+        # The lease state is tracked from the results of request_lease(),
+        # drop_lease() and the callback statuses rather than asking the
+        # library each time.
+        self.lease_state = LEASE_NONE
+        self.reconciler = None
+
+        # Every lease event gets the next generation number. The refresh
+        # hooks rebuild what's derived from the features, e.g. the feature
+        # snapshot, after each one.
+        self.generations = count(1)
+        self.generation = 0
+        self.refresh_hooks = {}
+        self.snapshot_schema = None
+        self.snapshot = FeatureSnapshot(0, LEASE_NONE, {})
+        self.gates = {}
+
+        # Feature name to [last value, handlers], see TurboFloat.watch().
+        self.watches = {}
+        self.watch_lock = threading.RLock()
+        self.watch_generation = 0
+
+        # Created by the first validate_dates().
+        self.date_memo = None
+
+        # The threads waiting in acquire_lease(), in arrival order. Only the
+        # first one talks to the server, and the last error it got is what
+        # the others raise if they time out.
+        self.lease_waiters = deque()
+        self.lease_condition = threading.Condition()
+        self.lease_error = None
+
+        # The users of lease() scopes. The lease is dropped when the last one
+        # leaves, unless it was requested outside of a scope.
+        self.scope_lock = threading.Lock()
+        self.scope_users = 0
+        self.scope_owns_lease = False
+        self.scope_timer = None
+
+    def bind_functions(self):
+        """
+        Binds the library functions that take a handle, with the handle already
+        converted to its argument type so ctypes doesn't convert it per call.
+        With metrics enabled they are wrapped to record every call.
+        """
 
-    def __init__(self, dat_file, guid, library_folder="", mode=TA_USER):
-        self._lib = load_library(library_folder)
-        self._set_restype()
+        handle_arg = c_uint32(self.handle)
+
+        for name in _HANDLE_FUNCTIONS:
+            func = partial(getattr(self.lib, name), handle_arg)
+            if self.metrics is not None:
+                func = self.metrics.instrument(name, func, _RESULT_CHECKS.get(name))
+            setattr(self, name, func)
+
+        func = self.lib.TF_Cleanup
+        if self.metrics is not None:
+            func = self.metrics.instrument("TF_Cleanup", func)
+        self.TF_Cleanup = func
+
+    def on_lease_event(self, status, context):
+        # Called on the library's thread, which mustn't be held up: only the
+        # wrapper's own state is updated here and the callbacks are run by
+        # the dispatcher thread.
+        metrics = self.metrics
+        if metrics is not None:
+            start = _now()
+
+        flight_recorder.record("callback", self.handle, None, status)
+
+        if status == TF_CB_FEATURES_CHANGED:
+            self.lease_state = LEASE_ACTIVE
+        else:
+            self.lease_state = LEASE_EXPIRED
+
+        # TF_CB_FEATURES_CHANGED, TF_CB_EXPIRED and TF_CB_EXPIRED_INET all
+        # invalidate the cached values, as does any undefined status since
+        # those must be treated as a failure to renew the lease. The
+        # generation goes first so reads still in flight don't cache what
+        # they got (see cache_feature()).
+        self.generation = next(self.generations)
+        self.feature_cache.clear()
+
+        if self.dispatcher is not None:
+            self.dispatcher.put(status, context)
+
+        if metrics is not None:
+            metrics.observe("callback", _now() - start)
+
+    def changed(self, lease_state):
+        """
+        Records a lease event caused by a call made through the wrapper and runs
+        the refresh hooks in the calling thread.
+        """
 
-        self._mode = mode
-        self._dat_file = wstr(dat_file)
-        self._callback = None
+        self.lease_state = lease_state
+        self.generation = next(self.generations)
+        self.feature_cache.clear()
+        self.refresh()
 
-        try:
-            self._lib.TF_PDetsFromPath(self._dat_file)
-        except TurboFloatFailError:
-            # The dat file is already loaded
-            pass
+    def cache_feature(self, name, value, generation):
+        """
+        Caches value, read when the generation was generation, unless a lease
+        event has happened since. Checking again after storing it covers an
+        event that clears the cache between the first check and the store.
+        """
+
+        if self.generation != generation:
+            return
+
+        cache = self.feature_cache
+        cache[name] = value
+
+        if self.generation != generation and cache.get(name) is value:
+            cache.pop(name, None)
+
+    def refresh(self):
+        """Runs the refresh hooks. An exception raised by one is printed."""
+
+        for hook in list(self.refresh_hooks.values()):
+            try:
+                hook()
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        """Stops the handle's threads once the library has freed it."""
+
+        self.lease_state = LEASE_NONE
 
-        self._handle = self._lib.TF_GetHandle(wstr(guid))
+        with self.lock:
+            reconciler, self.reconciler = self.reconciler, None
+            dispatcher, self.dispatcher = self.dispatcher, None
+
+        with self.scope_lock:
+            timer, self.scope_timer = self.scope_timer, None
+            self.scope_owns_lease = False
+
+        if timer is not None:
+            timer.cancel()
+        if reconciler is not None:
+            reconciler.stop()
+        if dispatcher is not None:
+            dispatcher.stop()
+
+
+def _get_shared_handle(lib, dat_file, guid):
+    key = (lib, dat_file, guid)
+
+    with _handles_lock:
+        shared = _handles.get(key)
+        if shared is not None:
+            return shared
+
+        if (lib, dat_file) not in _dat_files:
+            try:
+                lib.TF_PDetsFromPath(wstr(dat_file))
+            except TurboFloatFailError:
+                # The dat file is already loaded
+                pass
+            _dat_files.add((lib, dat_file))
+
+        handle = lib.TF_GetHandle(wstr(guid))
 
         # if the handle is still unset then immediately throw an exception
         # telling the user that they need to actually load the correct
         # TurboActivate.dat and/or use the correct GUID for the TurboActivate.dat
-        if self._handle == 0:
+        if handle == 0:
             raise TurboFloatDatFileError()
 
+        shared = _handles[key] = _SharedHandle(lib, handle)
+        return shared
+
+
+def _forget_handles(lib):
+    # TF_Cleanup() frees every handle the library has given out.
+    with _handles_lock:
+        forgotten = [_handles.pop(key) for key in list(_handles) if key[0] is lib]
+        _dat_files.difference_update([key for key in _dat_files if key[0] is lib])
+
+    for shared in forgotten:
+        shared.close()
+
+
+def _ignore_lease_event(status, context):
+    pass
+
+
+def _record_call(event, shared, start, error=None):
+    flight_recorder.record(event, shared.handle,
+                           type(error).__name__ if error is not None else None,
+                           None, _now() - start)
+
+
+class _CallbackDispatcher(threading.Thread):
+
+    """
+    Runs the callbacks of a handle for the lease events queued by its trampoline.
+    A TF_CB_FEATURES_CHANGED that arrives while the previous queued event is also
+    TF_CB_FEATURES_CHANGED is coalesced into it, and when the queue is full the
+    oldest event is dropped, so the library's thread never waits.
+    """
+
+    def __init__(self, shared, maxsize=CALLBACK_QUEUE_SIZE):
+        threading.Thread.__init__(self, name="turbofloat-callbacks")
+        self.daemon = True
+
+        self.maxsize = maxsize
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        self.dispatched = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.handler_calls = 0
+        self.handler_time = 0.0
+        self.handler_max_time = 0.0
+
+        self._shared = shared
+
+    def put(self, status, context):
+        with self.condition:
+            queue = self.queue
+
+            if status == TF_CB_FEATURES_CHANGED and queue and queue[-1][0] == status:
+                self.coalesced += 1
+                return
+
+            if len(queue) >= self.maxsize:
+                queue.popleft()
+                self.dropped += 1
+
+            queue.append((status, context))
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return CallbackStats(len(self.queue), self.dispatched, self.coalesced, self.dropped,
+                                 self.handler_calls, self.handler_time, self.handler_max_time)
+
+    def run(self):
+        shared = self._shared
+
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+                status, context = self.queue.popleft()
+                self.dispatched += 1
+
+            # The callbacks see what was derived from the new features.
+            shared.refresh()
+
+            for callback in list(shared.callbacks.values()):
+                start = _now()
+                try:
+                    callback(status, context)
+                except Exception:
+                    traceback.print_exc()
+                elapsed = _now() - start
+
+                with self.condition:
+                    self.handler_calls += 1
+                    self.handler_time += elapsed
+                    self.handler_max_time = max(self.handler_max_time, elapsed)
+
+                metrics = shared.metrics
+                if metrics is not None:
+                    metrics.observe("callback_handler", elapsed)
+
+
+class _DateMemo(object):
+
+    """
+    The results of is_date_valid() for validate_dates(). Everything is forgotten
+    at midnight UTC and when the wall clock jumps, and a date that passes before
+    midnight is only remembered until then.
+    """
+
+    def __init__(self):
+        self.reset(time.time())
+
+    def reset(self, wall):
+        self.results = {}
+        self.day = int(wall // _DAY)
+        self.wall = wall
+        self.monotonic = time.monotonic()
+
+    def check(self, wall):
+        """Returns the results, forgetting them first if the day or the clock changed."""
+
+        drift = (wall - self.wall) - (time.monotonic() - self.monotonic)
+        if int(wall // _DAY) != self.day or abs(drift) > _CLOCK_JUMP:
+            self.reset(wall)
+
+        return self.results
+
+    def expires(self, date, valid):
+        """The time until which the result for date holds."""
+
+        midnight = (self.day + 1) * _DAY
+        if not valid:
+            return midnight
+
+        try:
+            passes = (as_date(date) - _EPOCH).total_seconds()
+        except ValueError:
+            return midnight
+
+        return min(midnight, passes)
+
+
+class FeatureGate(object):
+
+    """
+    Whether a feature is enabled, kept up to date by the handle. See
+    TurboFloat.gate().
+    """
+
+    __slots__ = ("name", "predicate", "enabled", "generation")
+
+    def __init__(self, name, predicate):
+        self.name = name
+        self.predicate = predicate
+        self.enabled = False
+        self.generation = -1
+
+    def __bool__(self):
+        return self.enabled
+
+    def __repr__(self):
+        return "FeatureGate(%r, enabled=%r)" % (self.name, self.enabled)
+
+
+class _LeaseScope(ContextDecorator):
+
+    """See TurboFloat.lease()."""
+
+    def __init__(self, tf, linger):
+        self._tf = tf
+        self._linger = linger
+
+    def __enter__(self):
+        tf = self._tf
+        shared = tf._shared
+
+        # Held while requesting the lease, so other threads entering a scope
+        # wait for it rather than requesting it too.
+        with shared.scope_lock:
+            timer, shared.scope_timer = shared.scope_timer, None
+            if timer is not None:
+                timer.cancel()
+
+            if shared.lease_state != LEASE_ACTIVE:
+                try:
+                    tf.request_lease()
+                except TurboFloatLeaseAquiredError:
+                    pass
+                except TurboFloatError as e:
+                    if shared.scope_users == 0:
+                        shared.scope_owns_lease = False
+                    raise e
+
+                shared.scope_owns_lease = True
+
+            shared.scope_users += 1
+
+        return tf
+
+    def __exit__(self, *exc_info):
+        shared = self._tf._shared
+
+        with shared.scope_lock:
+            shared.scope_users -= 1
+            if shared.scope_users > 0 or not shared.scope_owns_lease:
+                return False
+
+            if self._linger > 0:
+                timer = threading.Timer(self._linger, self._expire)
+                timer.daemon = True
+                shared.scope_timer = timer
+                timer.start()
+                return False
+
+            self._drop(shared)
+
+        return False
+
+    def _expire(self):
+        shared = self._tf._shared
+
+        with shared.scope_lock:
+            if shared.scope_timer is not threading.current_thread():
+                # Cancelled by a new scope.
+                return
+
+            shared.scope_timer = None
+            try:
+                self._drop(shared)
+            except TurboFloatError:
+                traceback.print_exc()
+
+    def _drop(self, shared):
+        shared.scope_owns_lease = False
+
+        try:
+            self._tf.drop_lease()
+        except TurboFloatNoLeaseError:
+            pass
+
+
+class _LeaseReconciler(threading.Thread):
+
+    def __init__(self, tf, interval):
+        threading.Thread.__init__(self, name="turbofloat-reconciler")
+        self.daemon = True
+        self.interval = interval
+
+        self._tf = tf
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self._tf.reconcile_lease()
+            except TurboFloatError:
+                pass
+
+    def stop(self):
+        self._stopped.set()
+
+#
+# Object oriented interface
+#
+
+class TurboFloat(object):
+
+    def __init__(self, dat_file, guid, library_folder="", mode=TF_USER, lazy=False, preload=False,
+                 acquire=False, callback=None, acquire_timeout=None):
+        """
+        Loads the library and the dat file and gets the handle for guid.
+
+        With lazy that's put off until the first method that needs the handle is
+        called, so creating the object costs nothing and errors such as
+        TurboFloatDatFileError are raised from that method instead. With preload
+        it's done straight away on a background thread; methods called before it
+        finishes wait for it.
+
+        With acquire the background thread also sets callback (if given) and
+        calls acquire_lease(acquire_timeout), so the round trip to the server
+        overlaps with the rest of the application starting up. The server must
+        have been saved already, e.g. by the installer. ready is then a
+        concurrent.futures.Future of its LeaseAcquisition, and reading a
+        feature that isn't cached waits for it while there's no lease. If it
+        failed, such reads raise its error until there's a lease.
+        """
+
+        self._mode = mode
+        self._dat_file = dat_file
+        self._guid = guid
+        self._library_folder = library_folder
         self._callback = None
+        self._load_lock = threading.Lock()
+        self._ready = None
+        self._pending = None
+
+        if acquire:
+            self._ready = self._pending = Future()
+
+            thread = threading.Thread(target=self._acquire, args=(callback, acquire_timeout),
+                                      name="turbofloat-acquire")
+            thread.daemon = True
+            thread.start()
+        elif preload:
+            thread = threading.Thread(target=self._preload, name="turbofloat-preload")
+            thread.daemon = True
+            thread.start()
+        elif not lazy:
+            self._load()
 
     #
     # Public
     #
 
+    @property
+    def ready(self):
+        """
+        The Future of the lease acquisition started by the constructor with
+        acquire, or None.
+        """
+
+        return self._ready
+
     # TurboFloat server
 
     def save_server(self, host_address, port):
@@ -92,22 +668,28 @@ class TurboFloat(object):
         args.append(self._mode)
 
         try:
-            self._lib.TF_SaveServer(self._handle, *args)
+            self._shared.TF_SaveServer(*args)
         except TurboFloatError as e:
             raise e
 
-    def get_server(self, port):
-        """Gets the stored TurboFloat Server location."""
+    def get_server(self):
+        """Gets the stored TurboFloat Server location as a (host_address, port) tuple."""
 
-        buf_size = 255
-        buf = wbuf(buf_size)
+        buf = buffer_pool.get()
+        port = c_ushort()
 
-        try:
-            self._lib.TF_GetServer(self._handle, buf, buf_size, *port)
+        while True:
+            try:
+                self._shared.TF_GetServer(buf, len(buf), byref(port))
+                break
+            except TurboFloatBufferError as e:
+                if len(buf) >= buffer_pool.max_size:
+                    raise e
+                buf = buffer_pool.get(len(buf) * 2)
+            except TurboFloatError as e:
+                raise e
 
-            return buf.value
-        except TurboActivateFailError as e:
-            raise e
+        return buf.value, port.value
 
     # Set Lease Callback function
 
@@ -148,14 +730,53 @@ class TurboFloat(object):
         The lease callback function should handle everything defined below (see:
         "Possible callback statuses" at the bottom of this header). Everything that's
         not defined should be handled as a failure to renew the lease.
+
+        The callback isn't run on the library's own thread but on a dispatcher
+        thread, so a slow callback can't hold up the renewal of the lease. Back to
+        back TF_CB_FEATURES_CHANGED statuses are delivered once. has_lease() and the
+        feature cache are updated before the callback is queued, and the feature
+        snapshot before the callback is called.
         """
 
-        self._callback = LeaseCallbackTypeEx(callback)
+        shared = self._shared
 
-        try:
-            self._lib.TF_SetLeaseCallbackEx(self._handle, self._callback)
-        except TurboFloatError as e:
-            raise e
+        with shared.lock:
+            if shared.trampoline is None:
+                trampoline = LeaseCallbackTypeEx(shared.on_lease_event)
+
+                try:
+                    shared.TF_SetLeaseCallbackEx(trampoline, None)
+                except TurboFloatError as e:
+                    raise e
+
+                shared.trampoline = trampoline
+
+            if shared.dispatcher is None:
+                shared.dispatcher = _CallbackDispatcher(shared)
+                shared.dispatcher.start()
+
+            self._callback = callback
+            shared.callbacks[self] = callback
+
+    @property
+    def callback_queue_depth(self):
+        """The number of lease events waiting for the callbacks to handle them."""
+
+        dispatcher = self._shared.dispatcher
+        return len(dispatcher.queue) if dispatcher is not None else 0
+
+    def callback_stats(self):
+        """
+        Reports the queue depth, the number of lease events dispatched, coalesced
+        and dropped, and the number of callback calls, the total and the longest
+        time they took, as a CallbackStats.
+        """
+
+        dispatcher = self._shared.dispatcher
+        if dispatcher is None:
+            return CallbackStats(0, 0, 0, 0, 0, 0.0, 0.0)
+
+        return dispatcher.stats()
 
     # Leases
 
@@ -165,11 +786,127 @@ class TurboFloat(object):
         this at the top of your app after calling set_callback().
         """
 
+        shared = self._shared
+        self.clear_feature_cache()
+        start = _now()
+
         try:
-            self._lib.TF_RequestLease(self._handle)
+            shared.TF_RequestLease()
+        except TurboFloatLeaseAquiredError as e:
+            _record_call("request_lease", shared, start, e)
+            if shared.lease_state != LEASE_ACTIVE:
+                shared.changed(LEASE_ACTIVE)
+            raise e
         except TurboFloatError as e:
+            _record_call("request_lease", shared, start, e)
             raise e
 
+        _record_call("request_lease", shared, start)
+        shared.changed(LEASE_ACTIVE)
+
+    def acquire_lease(self, timeout=None, base_delay=0.5, max_delay=30.0):
+        """
+        Requests a lease, retrying with decorrelated jitter backoff while there are
+        no free leases or the server can't be reached, for at most timeout seconds
+        (forever if None). Any other error, e.g. TurboFloatWrongServerProductError
+        or TurboFloatUpgradeLibraryError, is raised straight away. On timeout the
+        last error is raised.
+
+        Threads calling this for the same handle queue up and the first one to
+        arrive is the only one to contact the server; the others return as soon as
+        it has the lease, or raise the last error it got if they time out. Returns
+        a LeaseAcquisition with the number of requests this call made and the
+        seconds it took.
+        """
+
+        shared = self._shared
+        condition = shared.lease_condition
+        start = _now()
+        deadline = None if timeout is None else start + timeout
+
+        attempts = 0
+        ticket = object()
+
+        with condition:
+            shared.lease_waiters.append(ticket)
+
+        try:
+            with condition:
+                while shared.lease_waiters[0] is not ticket:
+                    if shared.lease_state == LEASE_ACTIVE:
+                        return LeaseAcquisition(attempts, _now() - start)
+
+                    remaining = None if deadline is None else deadline - _now()
+                    if remaining is not None and remaining <= 0:
+                        error = shared.lease_error
+                        if error is None:
+                            raise TurboFloatNoFreeLeaseError()
+
+                        # A copy, as other waiters may be raising the same error.
+                        raise type(error)(*error.args) from error
+
+                    condition.wait(remaining)
+
+                shared.lease_error = None
+
+            delay = base_delay
+
+            while shared.lease_state != LEASE_ACTIVE:
+                attempts += 1
+
+                try:
+                    self.request_lease()
+                except TurboFloatLeaseAquiredError:
+                    pass
+                except _RETRY_ERRORS as e:
+                    delay = min(max_delay, random.uniform(base_delay, delay * 3))
+
+                    if deadline is not None:
+                        remaining = deadline - _now()
+                        if remaining <= 0:
+                            raise e
+                        delay = min(delay, remaining)
+
+                    # The waiters leaving notify the condition too, so the
+                    # backoff is waited out in full unless the lease turns up.
+                    wake = _now() + delay
+
+                    with condition:
+                        shared.lease_error = e
+
+                        while shared.lease_state != LEASE_ACTIVE:
+                            remaining = wake - _now()
+                            if remaining <= 0:
+                                break
+                            condition.wait(remaining)
+
+            return LeaseAcquisition(attempts, _now() - start)
+        finally:
+            with condition:
+                shared.lease_waiters.remove(ticket)
+                condition.notify_all()
+
+    def lease(self, linger=0.0):
+        """
+        Returns a context manager, also usable as a decorator, that holds the lease
+        while any thread is inside it:
+
+            with tf.lease(linger=5):
+                ...
+
+            @tf.lease()
+            def job():
+                ...
+
+        The first scope entered requests the lease, and scopes entered while it's
+        being requested wait for it. When the last one is left, the lease is
+        dropped, after linger seconds if linger is given, so scopes that come
+        and go quickly don't request and drop it each time. A lease requested
+        with request_lease() rather than by a scope is never dropped by one.
+        """
+
+        return _LeaseScope(self, linger)
+
     def drop_lease(self):
         """
         Drops the active lease from the TurboFloat Server. This frees up the lease
@@ -187,29 +924,89 @@ class TurboFloat(object):
             }
         """
 
+        shared = self._shared
+        start = _now()
+
         try:
-            self._lib.TF_DropLease(self._handle)
+            shared.TF_DropLease()
+        except TurboFloatNoLeaseError as e:
+            _record_call("drop_lease", shared, start, e)
+            shared.changed(LEASE_NONE)
+            raise e
         except TurboFloatError as e:
+            _record_call("drop_lease", shared, start, e)
             raise e
+        finally:
+            self.clear_feature_cache()
 
-        pass
+        _record_call("drop_lease", shared, start)
+        shared.changed(LEASE_NONE)
 
     def has_lease(self):
         """
-        Let's you know whether there's an active lease for the handle specified. This function
-        isn't necessary if you're tracking the responses from request_lease(), drop_lease(),
-        and the callback function that you set in set_callback().
+        Let's you know whether there's an active lease for the handle specified. The
+        answer comes from the responses to request_lease(), drop_lease() and the lease
+        callback statuses, so it doesn't call into the library. Use reconcile_lease()
+        to check with the library.
         """
 
-        ret = self._lib.TF_HasLease(self._handle)
+        return self._shared.lease_state == LEASE_ACTIVE
 
-        if ret == TA_OK:
-            return True
-        elif ret == TA_FAIL:
-            return False
+    @property
+    def lease_state(self):
+        """One of LEASE_NONE, LEASE_ACTIVE or LEASE_EXPIRED."""
+
+        return self._shared.lease_state
+
+    def reconcile_lease(self):
+        """
+        Asks the library whether there's an active lease with TF_HasLease() and
+        corrects the tracked lease state if it disagrees. Returns has_lease().
+        """
+
+        shared = self._shared
+        ret = shared.TF_HasLease()
+
+        # A correction is a lease event like any other: the cached values and
+        # everything derived from them belong to the lease that was lost.
+        if ret == TF_OK:
+            if shared.lease_state != LEASE_ACTIVE:
+                shared.changed(LEASE_ACTIVE)
+        elif ret == TF_FAIL:
+            if shared.lease_state == LEASE_ACTIVE:
+                shared.changed(LEASE_EXPIRED)
+        else:
+            # raise an error on all other return codes
+            _raise_error(ret, "TF_HasLease")
+
+        return shared.lease_state == LEASE_ACTIVE
+
+    def start_lease_reconciler(self, interval=60.0):
+        """
+        Calls reconcile_lease() every interval seconds on a background thread until
+        stop_lease_reconciler() or clean_up() is called. There's one reconciler per
+        handle, so starting it again only changes the interval.
+        """
+
+        shared = self._shared
+
+        with shared.lock:
+            if shared.reconciler is None:
+                shared.reconciler = _LeaseReconciler(self, interval)
+                shared.reconciler.start()
+            else:
+                shared.reconciler.interval = interval
+
+    def stop_lease_reconciler(self):
+        """Stops the thread started by start_lease_reconciler()."""
 
-        # raise an error on all other return codes
-        validate_result(ret)
+        shared = self._shared
+
+        with shared.lock:
+            reconciler, shared.reconciler = shared.reconciler, None
+
+        if reconciler is not None:
+            reconciler.stop()
 
     # Features
 
@@ -217,14 +1014,248 @@ class TurboFloat(object):
         return len(self.get_feature_value(name)) > 0
 
     def get_feature_value(self, name):
-        """Gets the value of a feature."""
-        buf_size = self._lib.TF_GetFeatureValue(self._handle, wstr(name), 0, 0)
-        buf = wbuf(buf_size)
+        """
+        Gets the value of a feature. Values are cached until the lease is
+        requested, dropped or the callback reports that it expired or that
+        the features changed.
+        """
 
-        self._lib.TF_GetFeatureValue(self._handle, wstr(name), buf, buf_size)
+        shared = self._shared
 
-        return buf.value
+        try:
+            value = shared.feature_cache[name]
+        except KeyError:
+            shared.feature_cache_misses += 1
+        else:
+            shared.feature_cache_hits += 1
+            return value
+
+        if self._pending is not None:
+            self._wait_ready()
+
+        generation = shared.generation
+        value = self._read_feature(self._feature_name(name))
+
+        shared.cache_feature(name, value, generation)
+        return value
+
+    def get_feature_values(self, names, skip_missing=False):
+        """
+        Gets the values of several features at once, returned as a dict keyed
+        by feature name. Cached values are used where possible.
+
+        With skip_missing the features that don't exist or are empty are left
+        out of the result instead of raising an error.
+        """
+
+        shared = self._shared
+        values = {}
+
+        if self._pending is not None:
+            self._wait_ready()
+
+        for name in names:
+            try:
+                value = shared.feature_cache[name]
+            except KeyError:
+                shared.feature_cache_misses += 1
+            else:
+                shared.feature_cache_hits += 1
+                if value or not skip_missing:
+                    values[name] = value
+                continue
+
+            generation = shared.generation
+            try:
+                value = self._read_feature(self._feature_name(name))
+            except TurboFloatFailError:
+                if skip_missing:
+                    continue
+                raise
+
+            shared.cache_feature(name, value, generation)
+            if value or not skip_missing:
+                values[name] = value
+
+        return values
+
+    def clear_feature_cache(self):
+        """Forgets every cached feature value."""
+
+        self._shared.feature_cache.clear()
+
+    def feature_cache_info(self):
+        """Reports the hits, misses and current size of the feature value cache."""
+
+        shared = self._shared
+        return FeatureCacheInfo(shared.feature_cache_hits,
+                                shared.feature_cache_misses,
+                                len(shared.feature_cache))
+
+    def set_feature_schema(self, schema):
+        """
+        Sets the features kept decoded in feature_snapshot: a dict mapping each
+        feature name to a function that decodes its value, e.g. as_int, as_bool
+        or as_date from turbofloat.snapshot, or None to keep the raw value. The
+        snapshot is rebuilt straight away and then after every lease event.
+        There's one schema per handle, so this replaces any schema set through
+        another TurboFloat for the same handle. Returns the new snapshot.
+        """
+
+        shared = self._shared
+
+        with shared.lock:
+            shared.snapshot_schema = dict(schema)
+            shared.refresh_hooks["snapshot"] = self._refresh_snapshot
+
+        self._refresh_snapshot(rebuild=True)
+        return shared.snapshot
+
+    def gate(self, name, predicate=None):
+        """
+        Returns a FeatureGate whose enabled attribute says whether the feature name
+        is enabled: whether there's a lease and predicate(value) is true, or,
+        without a predicate, the value isn't empty. It's worked out again after
+        every lease event, so checking it is only an attribute read:
+
+            hevc = tf.gate(b"hevc")
+            for frame in frames:
+                if hevc.enabled:
+                    ...
+
+        Gates are kept per handle, so asking again for the same name and
+        predicate returns the same gate.
+        """
+
+        shared = self._shared
+        key = (name, predicate)
+
+        with shared.lock:
+            gate = shared.gates.get(key)
+            if gate is not None:
+                return gate
+
+            gate = shared.gates[key] = FeatureGate(name, predicate)
+            shared.refresh_hooks["gates"] = self._refresh_gates
+
+        self._refresh_gates([gate])
+        return gate
+
+    def requires_feature(self, name, predicate=None):
+        """
+        A decorator for functions that may only run while the feature name is
+        enabled, as told by gate(name, predicate). Calling the function raises
+        TurboFloatFeatureDisabledError otherwise.
+        """
+
+        gate = self.gate(name, predicate)
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not gate.enabled:
+                    raise TurboFloatFeatureDisabledError(gate.name)
+                return func(*args, **kwargs)
+
+            wrapper.gate = gate
+            return wrapper
+
+        return decorator
+
+    def watch(self, name, handler):
+        """
+        Calls handler(name, old_value, new_value) whenever the value of the feature
+        name changes. After every lease event each watched feature is read once
+        and compared with its last value, and only the handlers of those that
+        changed are called. The value is None while there's no lease or the
+        feature doesn't exist. Handlers are called one at a time, on the callback
+        dispatcher thread or in the thread that called request_lease() or
+        drop_lease(). Watches are kept per handle. Returns handler.
+        """
+
+        shared = self._shared
+
+        with shared.watch_lock:
+            watch = shared.watches.get(name)
+            if watch is None:
+                watch = shared.watches[name] = [self._watched_value(name), []]
+            watch[1].append(handler)
+
+            shared.refresh_hooks["watches"] = self._refresh_watches
+
+        return handler
+
+    def unwatch(self, name, handler=None):
+        """Removes handler, or every handler, from the watch of the feature name."""
+
+        shared = self._shared
 
+        with shared.watch_lock:
+            watch = shared.watches.get(name)
+            if watch is None:
+                return
+
+            if handler is not None:
+                try:
+                    watch[1].remove(handler)
+                except ValueError:
+                    pass
+
+            if handler is None or not watch[1]:
+                del shared.watches[name]
+
+    @property
+    def feature_snapshot(self):
+        """
+        The latest FeatureSnapshot of the features named by set_feature_schema().
+        Reading it takes no lock and makes no library call.
+        """
+
+        return self._shared.snapshot
+
+    @property
+    def feature_generation(self):
+        """
+        The number of the latest lease event. A feature_snapshot with a lower
+        generation is out of date and about to be replaced.
+        """
+
+        return self._shared.generation
+
+    # Metrics
+
+    def enable_metrics(self, buckets=None):
+        """
+        Starts recording the calls made into the library for this handle and the
+        time spent handling lease callbacks. Returns the turbofloat.metrics.Metrics
+        object, which is shared by every TurboFloat using the same handle.
+        """
+
+        from turbofloat.metrics import DEFAULT_BUCKETS, Metrics
+
+        shared = self._shared
+
+        with shared.lock:
+            if shared.metrics is None:
+                shared.metrics = Metrics(buckets or DEFAULT_BUCKETS)
+                shared.bind_functions()
+
+            return shared.metrics
+
+    def disable_metrics(self):
+        """Stops recording metrics and goes back to calling the library directly."""
+
+        shared = self._shared
+
+        with shared.lock:
+            shared.metrics = None
+            shared.bind_functions()
+
+    @property
+    def metrics(self):
+        """The Metrics object, or None if metrics aren't enabled."""
+
+        return self._shared.metrics
 
     # Utils
 
@@ -234,7 +1265,7 @@ class TurboFloat(object):
         """
 
         try:
-            self._lib.TF_IsDateValid(self._handle, wstr(date), TF_HAS_NOT_EXPIRED)
+            self._shared.TF_IsDateValid(wstr(date), TF_HAS_NOT_EXPIRED)
 
             return True
         except TurboFloatFlagsError as e:
@@ -242,6 +1273,44 @@ class TurboFloat(object):
         except TurboFloatError:
             return False
 
+    def validate_dates(self, dates):
+        """
+        Checks many dates with is_date_valid(), returning an array('b') with 1 for
+        each date that is valid and 0 for each that isn't, in the order given.
+
+        Each distinct date is only passed to the library once per day: results are
+        remembered until midnight UTC, or until the date itself passes, and are
+        all forgotten if the system clock is changed. The result supports the
+        buffer protocol, e.g. numpy.frombuffer(result, dtype=bool).
+        """
+
+        shared = self._shared
+        memo = shared.date_memo
+        if memo is None:
+            memo = shared.date_memo = _DateMemo()
+
+        wall = time.time()
+        results = memo.check(wall)
+
+        valid_dates = array("b")
+        append = valid_dates.append
+
+        for date in dates:
+            try:
+                valid, expires = results[date]
+            except KeyError:
+                pass
+            else:
+                if wall < expires:
+                    append(valid)
+                    continue
+
+            valid = self.is_date_valid(date)
+            results[date] = (valid, memo.expires(date, valid))
+            append(valid)
+
+        return valid_dates
+
     def clean_up(self):
         """
         You should call this before your application exits. This frees up any
@@ -250,17 +1319,194 @@ class TurboFloat(object):
         """
 
         try:
-            self._lib.TF_Cleanup()
+            self._shared.TF_Cleanup()
         except TurboFloatError as e:
-            rasie e
-
-    def _set_restype(self):
-        self._lib.TF_SaveServer = validate_result
-        self._lib.TF_SetLeaseCallback = validate_result
-        self._lib.TF_RequestLease = validate_result
-        self._lib.TF_DropLease = validate_result
-        self._lib.TF_GetFeatureValue.restype = validate_result
-        self._lib.TF_GetServer.restype = validate_result
-        self._lib.TF_PDetsFromPath.restype = validate_result
-        self._lib.TF_Cleanup.restype = validate_result
-        self._lib.TF_IsDateValid.restype = validate_result
+            raise e
+        finally:
+            _forget_handles(self._lib)
+
+    #
+    # Private
+    #
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, i.e. before _load().
+        if name in ("_lib", "_handle", "_shared"):
+            self._load()
+            return self.__dict__[name]
+
+        raise AttributeError(name)
+
+    def _load(self):
+        with self._load_lock:
+            if "_shared" in self.__dict__:
+                return
+
+            lib = load_library(self._library_folder)
+            shared = _get_shared_handle(lib, self._dat_file, self._guid)
+
+            self._lib = lib
+            self._handle = shared.handle
+            self._shared = shared
+
+    def _acquire(self, callback, timeout):
+        future = self._ready
+
+        try:
+            self._load()
+            self.set_callback(callback if callback is not None else _ignore_lease_event)
+            acquisition = self.acquire_lease(timeout)
+        except BaseException as e:
+            # Left pending, so reads without a lease raise e rather than
+            # TurboFloatNoLeaseError.
+            future.set_exception(e)
+        else:
+            self._pending = None
+            future.set_result(acquisition)
+
+    def _wait_ready(self):
+        # Only while there's no lease: the refresh hooks read features on the
+        # acquiring thread once it has one.
+        pending = self._pending
+        if pending is None:
+            return
+
+        if self._shared.lease_state != LEASE_ACTIVE:
+            pending.result()
+        elif pending.done():
+            # Failed, but the lease has been requested since.
+            self._pending = None
+
+    def _preload(self):
+        try:
+            self._load()
+        except Exception:
+            # Raised again when the handle is first used.
+            pass
+
+    def _refresh_snapshot(self, rebuild=False):
+        """Builds the feature snapshot and publishes it unless a newer one is."""
+
+        shared = self._shared
+        schema = shared.snapshot_schema
+        if schema is None:
+            return
+
+        generation = shared.generation
+        lease_state = shared.lease_state
+
+        if lease_state == LEASE_ACTIVE:
+            snapshot = build_snapshot(generation, lease_state, schema, self._snapshot_value)
+        else:
+            snapshot = FeatureSnapshot(generation, lease_state, {})
+
+        with shared.lock:
+            current = shared.snapshot.generation
+            if generation > current or (rebuild and generation == current):
+                shared.snapshot = snapshot
+
+    def _refresh_gates(self, gates=None):
+        """Works out whether the gates are enabled, all of the handle's by default."""
+
+        shared = self._shared
+        generation = shared.generation
+        active = shared.lease_state == LEASE_ACTIVE
+
+        if gates is None:
+            gates = list(shared.gates.values())
+
+        states = []
+
+        for gate in gates:
+            enabled = False
+
+            if active:
+                try:
+                    value = self.get_feature_value(gate.name)
+                    if gate.predicate is None:
+                        enabled = len(value) > 0
+                    else:
+                        enabled = bool(gate.predicate(value))
+                except (TurboFloatFailError, TurboFloatNoLeaseError):
+                    pass
+                except Exception:
+                    traceback.print_exc()
+
+            states.append((gate, enabled))
+
+        with shared.lock:
+            for gate, enabled in states:
+                if generation >= gate.generation:
+                    gate.enabled = enabled
+                    gate.generation = generation
+
+    def _watched_value(self, name):
+        if self._shared.lease_state != LEASE_ACTIVE:
+            return None
+
+        try:
+            return self.get_feature_value(name)
+        except (TurboFloatFailError, TurboFloatNoLeaseError):
+            return None
+
+    def _refresh_watches(self):
+        """Reads every watched feature and calls the handlers of those that changed."""
+
+        shared = self._shared
+
+        with shared.watch_lock:
+            generation = shared.generation
+            if generation < shared.watch_generation:
+                # A newer event has been handled already.
+                return
+            shared.watch_generation = generation
+
+            changes = []
+
+            for name, watch in list(shared.watches.items()):
+                value = self._watched_value(name)
+                if value != watch[0]:
+                    changes.append((name, watch[0], value, list(watch[1])))
+                    watch[0] = value
+
+            for name, old_value, new_value, handlers in changes:
+                for handler in handlers:
+                    try:
+                        handler(name, old_value, new_value)
+                    except Exception:
+                        traceback.print_exc()
+
+    def _snapshot_value(self, name):
+        try:
+            return self.get_feature_value(name)
+        except (TurboFloatFailError, TurboFloatNoLeaseError):
+            raise KeyError(name)
+
+    def _feature_name(self, name):
+        names = self._shared.feature_names
+
+        try:
+            return names[name]
+        except KeyError:
+            return names.setdefault(name, wstr(name))
+
+    def _read_feature(self, name):
+        """
+        Reads a feature into this thread's pooled buffer. The size is only asked
+        for when the value doesn't fit in the buffer.
+        """
+
+        get_feature_value = self._shared.TF_GetFeatureValue
+        buf = buffer_pool.get()
+
+        try:
+            validate_result(get_feature_value(name, buf, len(buf)))
+        except TurboFloatBufferError:
+            buf_size = get_feature_value(name, None, 0)
+            if buf_size <= 0:
+                raise TurboFloatFailError()
+
+            buf = buffer_pool.get(buf_size)
+            validate_result(get_feature_value(name, buf, len(buf)))
+
+        return buf.value
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+asyncio interface to TurboFloat.
+
+The TurboFloat library talks to the server synchronously, so the calls that
+may go over the network run in an executor and the lease callback, which the
+library calls from its own background thread, is handed over to the event loop.
+"""
+
+import asyncio
+import functools
+
+from turbofloat import TurboFloat
+from turbofloat.c_wrapper import TF_USER, TurboFloatError
+
+
+class AsyncTurboFloat(object):
+
+    def __init__(self, dat_file, guid, library_folder="", mode=TF_USER, executor=None):
+        self._tf = TurboFloat(dat_file, guid, library_folder, mode)
+        self._executor = executor
+
+        self._loop = None
+        self._callback = None
+        self._subscribers = set()
+
+        # Counts the calls to request_lease(), so a request that was given up
+        # on can tell whether a later one is relying on its lease.
+        self._requests = 0
+
+    @property
+    def turbofloat(self):
+        """The blocking TurboFloat object the calls are made on."""
+
+        return self._tf
+
+    # TurboFloat server
+
+    async def save_server(self, host_address, port, timeout=None):
+        """Saves the TurboFloat server location. See TurboFloat.save_server()."""
+
+        await self._run(timeout, self._tf.save_server, host_address, port)
+
+    async def get_server(self, timeout=None):
+        """Gets the stored TurboFloat Server location. See TurboFloat.get_server()."""
+
+        return await self._run(timeout, self._tf.get_server)
+
+    # Set Lease Callback function
+
+    def set_callback(self, callback):
+        """
+        Set the function that is called on the event loop for every lease event. It
+        is passed the callback status and may be a coroutine function, in which case
+        it is scheduled as a task.
+
+        The callback is registered with the library by the first awaited lease call.
+        Lease events are also available from events().
+        """
+
+        self._callback = callback
+
+    async def events(self):
+        """
+        Yields the status of every lease event received from now on, e.g.:
+
+            async for status in tf.events():
+                if status == TF_CB_FEATURES_CHANGED:
+                    ...
+        """
+
+        self._install_callback()
+
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers.discard(queue)
+
+    # Leases
+
+    async def request_lease(self, timeout=None):
+        """
+        Requests a floating license lease from the TurboFloat Server.
+
+        If timeout expires or the caller is cancelled while the request is still
+        in flight then the request carries on in the background and, should it
+        succeed, the lease is dropped again so it isn't held without anyone
+        knowing about it. It's kept if request_lease() has been called again
+        since, as that call may be relying on it.
+        """
+
+        self._install_callback()
+
+        self._requests += 1
+        request = self._requests
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._tf.request_lease)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            future.add_done_callback(functools.partial(self._drop_abandoned_lease, request))
+            raise
+
+    async def drop_lease(self, timeout=None):
+        """Drops the active lease from the TurboFloat Server."""
+
+        await self._run(timeout, self._tf.drop_lease)
+
+    def has_lease(self):
+        """See TurboFloat.has_lease()."""
+
+        return self._tf.has_lease()
+
+    # Features
+
+    async def has_feature(self, name, timeout=None):
+        return len(await self.get_feature_value(name, timeout)) > 0
+
+    async def get_feature_value(self, name, timeout=None):
+        """
+        Gets the value of a feature. Cached values are returned straight away,
+        anything else is read in the executor.
+        """
+
+        try:
+            return self._tf._shared.feature_cache[name]
+        except KeyError:
+            pass
+
+        return await self._run(timeout, self._tf.get_feature_value, name)
+
+    async def get_feature_values(self, names, skip_missing=False, timeout=None):
+        """See TurboFloat.get_feature_values()."""
+
+        return await self._run(timeout, self._tf.get_feature_values, list(names), skip_missing)
+
+    # Utils
+
+    def is_date_valid(self, date):
+        """See TurboFloat.is_date_valid()."""
+
+        return self._tf.is_date_valid(date)
+
+    async def clean_up(self, timeout=None):
+        """See TurboFloat.clean_up()."""
+
+        await self._run(timeout, self._tf.clean_up)
+
+    #
+    # Private
+    #
+
+    async def _run(self, timeout, func, *args):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args)
+
+        return await asyncio.wait_for(loop.run_in_executor(self._executor, call), timeout)
+
+    def _install_callback(self):
+        # The loop is only remembered once the callback is set, so a failed
+        # set_callback() is tried again by the next call.
+        if self._loop is None:
+            loop = asyncio.get_running_loop()
+            self._tf.set_callback(self._on_lease_event)
+            self._loop = loop
+
+    def _on_lease_event(self, status, context):
+        # Called on the TurboFloat library's thread.
+        self._loop.call_soon_threadsafe(self._dispatch_lease_event, status)
+
+    def _dispatch_lease_event(self, status):
+        for queue in self._subscribers:
+            queue.put_nowait(status)
+
+        if self._callback is not None:
+            result = self._callback(status)
+            if asyncio.iscoroutine(result):
+                self._loop.create_task(result)
+
+    def _drop_abandoned_lease(self, request, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if request != self._requests:
+            return
+
+        self._loop.run_in_executor(self._executor, self._drop_lease_quietly, request)
+
+    def _drop_lease_quietly(self, request):
+        # Checked again, a request may have started while this was queued.
+        if request != self._requests:
+            return
+
+        try:
+            self._tf.drop_lease()
+        except TurboFloatError:
+            pass
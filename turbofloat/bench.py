@@ -0,0 +1,647 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Microbenchmarks of the binding's hot paths.
+
+The benchmarks load a stub of the TurboFloat library, compiled from C with the
+system's compiler (cc, or $CC) when they start, through load_library(). Its
+functions return straight away, so the results are the cost of the Python
+and ctypes layers rather than of the TurboFloat library or server:
+
+    python -m turbofloat.bench --output before.json
+
+With --fake they run against turbofloat.testing.FakeLibrary instead, which
+needs no compiler but replaces the ctypes calls with Python ones, so only
+the cost of the Python layer is measured.
+
+Each benchmark reports operations per second, the 50th and 99th percentile
+latency of single calls in nanoseconds (including the cost of reading the
+clock), and per call the peak memory allocated in bytes and the number of
+memory blocks still allocated afterwards, as measured by tracemalloc.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import turbofloat
+from turbofloat import TurboFloat
+from turbofloat.c_wrapper import *
+from turbofloat.c_wrapper import _LIBRARY_NAME
+from turbofloat.testing import FakeLibrary, install, uninstall
+
+_LIBRARY_FOLDER = "turbofloat-bench"
+_FEATURES = {
+    b"seats": b"5",
+    b"edition": b"professional",
+    b"expires": b"2999-12-31 00:00:00",
+}
+
+# Set by run(): the folder the benchmarked TurboFloat objects load the library
+# from and the stub library loaded from it, or None with FakeLibrary.
+_folder = _LIBRARY_FOLDER
+_stub = None
+
+# The stub library. It has the same features as _FEATURES, a server and
+# callback per handle and unlimited leases, and TF_Stub_Fire() calls a
+# handle's lease callback, as the library's own thread would. It takes char
+# strings, so it can't stand in for the Windows library.
+_STUB_SOURCE = r"""
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <time.h>
+
+#define TF_OK 0x00
+#define TF_FAIL 0x01
+#define TF_E_SERVER 0x02
+#define TF_E_NO_CALLBACK 0x03
+#define TF_E_LEASE_EXISTS 0x06
+#define TF_E_INVALID_HANDLE 0x09
+#define TF_E_NO_LEASE 0x0A
+#define TF_E_INSUFFICIENT_BUFFER 0x0C
+#define TF_E_INVALID_FLAGS 0x0E
+#define TF_HAS_NOT_EXPIRED 0x01
+
+#define MAX_HANDLES 64
+#define MAX_GUID 256
+
+typedef void (*callback_t)(uint32_t);
+typedef void (*callback_ex_t)(uint32_t, void *);
+
+static const char *features[][2] = {
+    {"seats", "5"},
+    {"edition", "professional"},
+    {"expires", "2999-12-31 00:00:00"},
+};
+
+static int loaded;
+static uint32_t handles;
+static char guids[MAX_HANDLES][MAX_GUID];
+static char servers[MAX_HANDLES][MAX_GUID];
+static unsigned short ports[MAX_HANDLES];
+static int leases[MAX_HANDLES];
+static callback_t callbacks[MAX_HANDLES];
+static callback_ex_t callbacks_ex[MAX_HANDLES];
+static void *contexts[MAX_HANDLES];
+
+static int valid(uint32_t handle)
+{
+    return handle >= 1 && handle <= handles;
+}
+
+int TF_PDetsFromPath(const char *path)
+{
+    if (loaded)
+        return TF_FAIL;
+    loaded = 1;
+    return TF_OK;
+}
+
+uint32_t TF_GetHandle(const char *guid)
+{
+    uint32_t i;
+
+    if (!loaded)
+        return 0;
+
+    for (i = 0; i < handles; i++)
+        if (strcmp(guids[i], guid) == 0)
+            return i + 1;
+
+    if (handles == MAX_HANDLES || strlen(guid) >= MAX_GUID)
+        return 0;
+
+    strcpy(guids[handles], guid);
+    return ++handles;
+}
+
+int TF_SaveServer(uint32_t handle, const char *host, unsigned short port, uint32_t flags)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (flags != 1 && flags != 2)
+        return TF_E_INVALID_FLAGS;
+    if (strlen(host) >= MAX_GUID)
+        return TF_FAIL;
+
+    strcpy(servers[handle - 1], host);
+    ports[handle - 1] = port;
+    return TF_OK;
+}
+
+int TF_GetServer(uint32_t handle, char *buf, int size, unsigned short *port)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (!servers[handle - 1][0])
+        return TF_FAIL;
+    if ((int)strlen(servers[handle - 1]) + 1 > size)
+        return TF_E_INSUFFICIENT_BUFFER;
+
+    strcpy(buf, servers[handle - 1]);
+    if (port)
+        *port = ports[handle - 1];
+    return TF_OK;
+}
+
+int TF_SetLeaseCallback(uint32_t handle, callback_t callback)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (leases[handle - 1])
+        return TF_E_LEASE_EXISTS;
+
+    callbacks[handle - 1] = callback;
+    callbacks_ex[handle - 1] = NULL;
+    return TF_OK;
+}
+
+int TF_SetLeaseCallbackEx(uint32_t handle, callback_ex_t callback, void *context)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (leases[handle - 1])
+        return TF_E_LEASE_EXISTS;
+
+    callbacks[handle - 1] = NULL;
+    callbacks_ex[handle - 1] = callback;
+    contexts[handle - 1] = context;
+    return TF_OK;
+}
+
+int TF_RequestLease(uint32_t handle)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (!callbacks[handle - 1] && !callbacks_ex[handle - 1])
+        return TF_E_NO_CALLBACK;
+    if (!servers[handle - 1][0])
+        return TF_E_SERVER;
+    if (leases[handle - 1])
+        return TF_E_LEASE_EXISTS;
+
+    leases[handle - 1] = 1;
+    return TF_OK;
+}
+
+int TF_DropLease(uint32_t handle)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (!leases[handle - 1])
+        return TF_E_NO_LEASE;
+
+    leases[handle - 1] = 0;
+    return TF_OK;
+}
+
+int TF_HasLease(uint32_t handle)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+
+    return leases[handle - 1] ? TF_OK : TF_FAIL;
+}
+
+int TF_GetFeatureValue(uint32_t handle, const char *name, char *buf, int size)
+{
+    size_t i;
+
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (!leases[handle - 1])
+        return TF_E_NO_LEASE;
+
+    for (i = 0; i < sizeof(features) / sizeof(features[0]); i++) {
+        int length = (int)strlen(features[i][1]) + 1;
+
+        if (strcmp(features[i][0], name) != 0)
+            continue;
+        if (!buf)
+            return length;
+        if (length > size)
+            return TF_E_INSUFFICIENT_BUFFER;
+
+        memcpy(buf, features[i][1], length);
+        return TF_OK;
+    }
+
+    return buf ? TF_FAIL : 0;
+}
+
+/* Days since 1970-01-01 of a date in the proleptic Gregorian calendar. */
+static long days_from_civil(long y, long m, long d)
+{
+    long era, yoe, doy, doe;
+
+    y -= m <= 2;
+    era = (y >= 0 ? y : y - 399) / 400;
+    yoe = y - era * 400;
+    doy = (153 * (m + (m > 2 ? -3 : 9)) + 2) / 5 + d - 1;
+    doe = yoe * 365 + yoe / 4 - yoe / 100 + doy;
+    return era * 146097 + doe - 719468;
+}
+
+int TF_IsDateValid(uint32_t handle, const char *date, uint32_t flags)
+{
+    int year, month, day, hour = 0, minute = 0, second = 0, fields;
+    double expires;
+
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+    if (flags != TF_HAS_NOT_EXPIRED)
+        return TF_E_INVALID_FLAGS;
+
+    fields = sscanf(date, "%d-%d-%d %d:%d:%d", &year, &month, &day, &hour, &minute, &second);
+    if (fields != 3 && fields != 6)
+        return TF_FAIL;
+
+    expires = days_from_civil(year, month, day) * 86400.0 + hour * 3600 + minute * 60 + second;
+    return expires > (double)time(NULL) ? TF_OK : TF_FAIL;
+}
+
+int TF_Cleanup(void)
+{
+    loaded = 0;
+    handles = 0;
+    memset(guids, 0, sizeof(guids));
+    memset(servers, 0, sizeof(servers));
+    memset(ports, 0, sizeof(ports));
+    memset(leases, 0, sizeof(leases));
+    memset(callbacks, 0, sizeof(callbacks));
+    memset(callbacks_ex, 0, sizeof(callbacks_ex));
+    return TF_OK;
+}
+
+int TF_Stub_Fire(uint32_t handle, uint32_t status)
+{
+    if (!valid(handle))
+        return TF_E_INVALID_HANDLE;
+
+    if (callbacks_ex[handle - 1])
+        callbacks_ex[handle - 1](status, contexts[handle - 1]);
+    else if (callbacks[handle - 1])
+        callbacks[handle - 1](status);
+    return TF_OK;
+}
+"""
+
+_now = time.perf_counter
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(func, iterations):
+    """Runs func iterations times and returns its statistics as a dict."""
+
+    # Throughput, without the cost of timing every call.
+    start = _now()
+    for _ in range(iterations):
+        func()
+    elapsed = _now() - start
+
+    # Latency of single calls.
+    samples = []
+    for _ in range(iterations):
+        start = _now()
+        func()
+        samples.append(_now() - start)
+    samples.sort()
+
+    # Memory, over fewer calls since tracing is slow.
+    calls = min(iterations, 1000)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peak = 0
+        blocks = sys.getallocatedblocks()
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func()
+            peak += tracemalloc.get_traced_memory()[1] - baseline
+        blocks = sys.getallocatedblocks() - blocks
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed else float("inf"),
+        "p50_ns": _percentile(samples, 0.50) * 1e9,
+        "p99_ns": _percentile(samples, 0.99) * 1e9,
+        "alloc_bytes_per_call": float(peak) / calls,
+        "retained_blocks_per_call": float(blocks) / calls,
+    }
+
+
+#
+# Benchmarks
+#
+
+def build_stub(folder):
+    """
+    Compiles the stub library into folder, named like the TurboFloat library, so
+    load_library(folder) loads it. Raises CalledProcessError or OSError if it
+    can't be compiled.
+    """
+
+    if sys.platform == "win32":
+        raise OSError("the stub library can't be built on Windows, use --fake")
+
+    source = os.path.join(folder, "stub.c")
+    with open(source, "w") as f:
+        f.write(_STUB_SOURCE)
+
+    subprocess.check_call([os.environ.get("CC", "cc"), "-shared", "-fPIC", "-O2",
+                           "-o", os.path.join(folder, _LIBRARY_NAME), source])
+
+    lib = load_library(folder)
+    lib.TF_Stub_Fire.argtypes = [c_uint32, c_uint32]
+    return lib
+
+
+def _fire(lib, status, handle):
+    if _stub is None:
+        lib.fire(status, handle)
+    else:
+        lib.TF_Stub_Fire(handle, status)
+
+
+def _leased():
+    """A TurboFloat with a lease, on a fresh FakeLibrary or a cleaned up stub."""
+
+    if _stub is None:
+        uninstall(_folder)
+        lib = install(FakeLibrary(features=_FEATURES), _folder)
+    else:
+        lib = _stub
+        lib.TF_Cleanup()
+        turbofloat._forget_handles(lib)
+
+    tf = TurboFloat(b"TurboActivate.dat", b"bench", _folder)
+    tf.save_server(b"127.0.0.1", 13)
+    tf.set_callback(lambda status, context: None)
+    tf.request_lease()
+    return lib, tf
+
+
+def bench_construction(iterations):
+    _leased()
+    return measure(lambda: TurboFloat(b"TurboActivate.dat", b"bench", _folder),
+                   iterations)
+
+
+def bench_construction_lazy(iterations):
+    _leased()
+    return measure(lambda: TurboFloat(b"TurboActivate.dat", b"bench", _folder, lazy=True),
+                   iterations)
+
+
+def bench_first_call_lazy(iterations):
+    """Creating a lazy TurboFloat and making the first call, which loads it."""
+
+    _leased()
+    return measure(lambda: TurboFloat(b"TurboActivate.dat", b"bench", _folder,
+                                      lazy=True).has_lease(),
+                   iterations)
+
+
+def bench_import(iterations):
+    """The time taken by import turbofloat in a new interpreter, from -X importtime."""
+
+    samples = []
+
+    for _ in range(min(iterations, 20)):
+        output = subprocess.check_output([sys.executable, "-X", "importtime", "-c",
+                                          "import turbofloat"],
+                                         stderr=subprocess.STDOUT, universal_newlines=True)
+        for line in output.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) == 3 and fields[2] == "turbofloat":
+                samples.append(int(fields[1]) * 1e-6)
+    samples.sort()
+
+    return {
+        "iterations": len(samples),
+        "p50_ns": _percentile(samples, 0.50) * 1e9,
+        "p99_ns": _percentile(samples, 0.99) * 1e9,
+    }
+
+
+def bench_has_lease(iterations):
+    _, tf = _leased()
+    return measure(tf.has_lease, iterations)
+
+
+def bench_get_feature_value(iterations):
+    _, tf = _leased()
+    return measure(lambda: tf.get_feature_value(b"edition"), iterations)
+
+
+def bench_get_feature_value_uncached(iterations):
+    _, tf = _leased()
+
+    def read():
+        tf.clear_feature_cache()
+        tf.get_feature_value(b"edition")
+
+    return measure(read, iterations)
+
+
+def bench_feature_snapshot(iterations):
+    """Reading a decoded value from the feature snapshot."""
+
+    _, tf = _leased()
+    tf.set_feature_schema({b"seats": int})
+    return measure(lambda: tf.feature_snapshot.get(b"seats"), iterations)
+
+
+def bench_gate(iterations):
+    """Checking a feature gate."""
+
+    _, tf = _leased()
+    gate = tf.gate(b"edition")
+    return measure(lambda: gate.enabled, iterations)
+
+
+def bench_has_feature(iterations):
+    _, tf = _leased()
+    return measure(lambda: tf.has_feature(b"seats"), iterations)
+
+
+def bench_is_date_valid(iterations):
+    _, tf = _leased()
+    return measure(lambda: tf.is_date_valid(b"2999-12-31 00:00:00"), iterations)
+
+
+def bench_validate_dates(iterations):
+    """validate_dates() on 100 dates, 4 of them distinct."""
+
+    _, tf = _leased()
+    dates = [b"2999-12-31 00:00:00", b"2999-12-31", b"2000-01-01", b"not a date"] * 25
+    return measure(lambda: tf.validate_dates(dates), iterations)
+
+
+def bench_validate_result_error(iterations):
+    def fail():
+        try:
+            validate_result(TF_E_ENABLE_NETWORK_ADAPTERS)
+        except TurboFloatError:
+            pass
+
+    return measure(fail, iterations)
+
+
+def bench_callback_delivery(iterations):
+    """
+    Time from the library calling the lease callback to the user's callback running
+    on the dispatcher thread.
+    """
+
+    lib, tf = _leased()
+    handle = tf._handle
+    delivered = threading.Event()
+    times = []
+
+    def callback(status, context):
+        times.append(_now())
+        delivered.set()
+
+    tf.set_callback(callback)
+
+    def fire():
+        delivered.clear()
+        del times[:]
+        start = _now()
+        _fire(lib, TF_CB_FEATURES_CHANGED, handle)
+        delivered.wait()
+        return times[0] - start
+
+    result = measure(fire, iterations)
+
+    latencies = sorted(fire() for _ in range(iterations))
+    result["delivery_p50_ns"] = _percentile(latencies, 0.50) * 1e9
+    result["delivery_p99_ns"] = _percentile(latencies, 0.99) * 1e9
+    return result
+
+
+BENCHMARKS = {
+    "construction": bench_construction,
+    "construction_lazy": bench_construction_lazy,
+    "first_call_lazy": bench_first_call_lazy,
+    "import": bench_import,
+    "has_lease": bench_has_lease,
+    "get_feature_value": bench_get_feature_value,
+    "get_feature_value_uncached": bench_get_feature_value_uncached,
+    "feature_snapshot": bench_feature_snapshot,
+    "gate": bench_gate,
+    "has_feature": bench_has_feature,
+    "is_date_valid": bench_is_date_valid,
+    "validate_dates": bench_validate_dates,
+    "validate_result_error": bench_validate_result_error,
+    "callback_delivery": bench_callback_delivery,
+}
+
+
+def run(names=None, iterations=10000, fake=False):
+    """
+    Runs the named benchmarks (all by default) against the stub library, or
+    FakeLibrary if fake, and returns the report as a dict.
+    """
+
+    global _folder, _stub
+
+    results = {}
+    folder = None
+
+    try:
+        if fake:
+            _folder, _stub = _LIBRARY_FOLDER, None
+        else:
+            folder = tempfile.mkdtemp(prefix="turbofloat-bench-")
+            _folder, _stub = folder, build_stub(folder)
+
+        for name in names or sorted(BENCHMARKS):
+            results[name] = BENCHMARKS[name](iterations)
+    finally:
+        if _stub is not None:
+            _stub.TF_Cleanup()
+            turbofloat._forget_handles(_stub)
+        else:
+            uninstall(_folder)
+
+        _folder, _stub = _LIBRARY_FOLDER, None
+
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return {
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "platform": platform.platform(),
+        "library": "fake" if fake else "stub",
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m turbofloat.bench",
+                                     description="Benchmark the TurboFloat binding.")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="benchmarks to run, from: %s (default: all)"
+                             % ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("-n", "--iterations", type=int, default=10000,
+                        help="calls per benchmark (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="write the JSON report to this file")
+    parser.add_argument("--fake", action="store_true",
+                        help="run against FakeLibrary instead of the compiled stub library")
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+
+    report = json.dumps(run(args.benchmarks, args.iterations, args.fake), indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Sharing one lease between the processes on a host.
+
+A LeaseBroker holds the real lease through a TurboFloat object and serves it
+over a Unix domain socket. Worker processes use a BrokerClient, which has the
+same interface as TurboFloat, so a pre-forking server needs one floating seat
+per host instead of one per worker:
+
+    # In the parent process
+    broker = LeaseBroker(TurboFloat(dat_file, guid), "/run/myapp/turbofloat.sock")
+    broker.start()
+
+    # In each worker
+    tf = BrokerClient("/run/myapp/turbofloat.sock")
+    tf.set_callback(on_lease_event)
+    tf.request_lease()
+
+Messages are a 5 byte header, an opcode (requests) or TF_* return code
+(responses), followed by the length of the payload:
+
+    struct.pack("!BI", opcode_or_code, len(payload)) + payload
+
+A client connection that sends OP_SUBSCRIBE receives no more responses;
+instead the broker writes one header per lease callback, with the callback
+status in place of the return code.
+"""
+
+import os
+import socket
+import socketserver
+import struct
+import threading
+import traceback
+from itertools import count
+
+from turbofloat.c_wrapper import *
+from turbofloat.c_wrapper import _ERROR_CODES
+
+_HEADER = struct.Struct("!BI")
+
+OP_REQUEST_LEASE = 1
+OP_DROP_LEASE = 2
+OP_HAS_LEASE = 3
+OP_GET_FEATURE_VALUE = 4
+OP_IS_DATE_VALID = 5
+OP_SAVE_SERVER = 6
+OP_SUBSCRIBE = 7
+OP_GET_SERVER = 8
+
+_PORT = struct.Struct("!H")
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _send_message(sock, code, payload=b""):
+    sock.sendall(_HEADER.pack(code, len(payload)) + payload)
+
+
+def _recv_message(sock):
+    code, size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return code, _recv_exactly(sock, size) if size else b""
+
+
+#
+# Broker
+#
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.holds_lease = False
+
+    def handle(self):
+        broker = self.server.broker
+
+        while True:
+            try:
+                opcode, payload = _recv_message(self.request)
+            except (EOFError, OSError):
+                return
+
+            if opcode == OP_SUBSCRIBE:
+                broker._subscribe(self.request)
+                return
+
+            try:
+                code, payload = broker._handle(self, opcode, payload)
+            except TurboFloatError as e:
+                code, payload = _ERROR_CODES.get(type(e), TF_FAIL), b""
+
+            try:
+                _send_message(self.request, code, payload)
+            except OSError:
+                return
+
+    def finish(self):
+        self.server.broker._release(self)
+
+
+class _BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class LeaseBroker(object):
+
+    """
+    Serves the lease of a TurboFloat object to BrokerClient objects in other
+    processes.
+
+    The broker requests the real lease the first time a client asks for one
+    and then keeps it until close(), so workers that restart don't cause any
+    traffic to the TurboFloat server. Lease callbacks are relayed to every
+    client.
+
+    The socket is only accessible to the broker's user, since any client can
+    change the server the lease is requested from. Pass mode, e.g. 0o660, to
+    let the workers connect as other users.
+    """
+
+    def __init__(self, tf, path, mode=0o600):
+        self._tf = tf
+        self._path = path
+        self._mode = mode
+
+        self._lock = threading.Lock()
+        self._leased = False
+        self._holders = set()
+        self._subscribers = []
+
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Starts serving on a background thread."""
+
+        self._tf.set_callback(self._on_lease_event)
+
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+        # The mode is set before listening, so no client can connect while
+        # the socket still has the umask's permissions.
+        server = _BrokerServer(self._path, _BrokerHandler, bind_and_activate=False)
+
+        try:
+            server.server_bind()
+            os.chmod(self._path, self._mode)
+            server.server_activate()
+        except Exception:
+            server.server_close()
+            raise
+
+        self._server = server
+        self._server.broker = self
+
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="turbofloat-broker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stops serving and drops the lease, if it's held."""
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+            leased, self._leased = self._leased, False
+            self._holders.clear()
+
+        for sock in subscribers:
+            sock.close()
+
+        if leased:
+            try:
+                self._tf.drop_lease()
+            except TurboFloatNoLeaseError:
+                pass
+
+    #
+    # Private
+    #
+
+    def _handle(self, client, opcode, payload):
+        if opcode == OP_REQUEST_LEASE:
+            with self._lock:
+                if client.holds_lease:
+                    raise TurboFloatLeaseAquiredError()
+
+                if not self._leased:
+                    try:
+                        self._tf.request_lease()
+                    except TurboFloatLeaseAquiredError:
+                        pass
+                    self._leased = True
+
+                client.holds_lease = True
+                self._holders.add(client)
+
+            return TF_OK, b""
+
+        if opcode == OP_DROP_LEASE:
+            with self._lock:
+                if not client.holds_lease:
+                    raise TurboFloatNoLeaseError()
+
+                client.holds_lease = False
+                self._holders.discard(client)
+
+            return TF_OK, b""
+
+        if opcode == OP_HAS_LEASE:
+            return (TF_OK if client.holds_lease else TF_FAIL), b""
+
+        if opcode == OP_GET_FEATURE_VALUE:
+            if not client.holds_lease:
+                raise TurboFloatNoLeaseError()
+
+            return TF_OK, self._tf.get_feature_value(payload)
+
+        if opcode == OP_IS_DATE_VALID:
+            return (TF_OK if self._tf.is_date_valid(payload) else TF_FAIL), b""
+
+        if opcode == OP_SAVE_SERVER:
+            port, = _PORT.unpack_from(payload)
+            self._tf.save_server(payload[_PORT.size:], port)
+            return TF_OK, b""
+
+        if opcode == OP_GET_SERVER:
+            host_address, port = self._tf.get_server()
+            return TF_OK, _PORT.pack(port) + host_address
+
+        raise TurboFloatFailError()
+
+    def _release(self, client):
+        with self._lock:
+            self._holders.discard(client)
+
+    def _subscribe(self, sock):
+        with self._lock:
+            self._subscribers.append(sock)
+
+        # Keep the connection open until the client goes away.
+        try:
+            while sock.recv(1):
+                pass
+        except OSError:
+            pass
+
+        with self._lock:
+            if sock in self._subscribers:
+                self._subscribers.remove(sock)
+
+    def _on_lease_event(self, status, context):
+        with self._lock:
+            if status != TF_CB_FEATURES_CHANGED:
+                # The lease is gone, the clients need to request it again.
+                self._leased = False
+                for client in self._holders:
+                    client.holds_lease = False
+                self._holders.clear()
+
+            subscribers = list(self._subscribers)
+
+        for sock in subscribers:
+            try:
+                _send_message(sock, status)
+            except OSError:
+                pass
+
+
+#
+# Client
+#
+
+class BrokerClient(object):
+
+    """
+    Talks to a LeaseBroker and offers the same methods as TurboFloat. Feature
+    values are cached until the broker relays a lease event.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._callback = None
+
+        # Bumped before the cache is cleared, so a read that was in flight
+        # when a lease event arrived doesn't cache what it got.
+        self._feature_cache = {}
+        self._generations = count(1)
+        self._generation = 0
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+
+        self._events = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._events.connect(path)
+        _send_message(self._events, OP_SUBSCRIBE)
+
+        self._thread = threading.Thread(target=self._read_events, name="turbofloat-broker-events")
+        self._thread.daemon = True
+        self._thread.start()
+
+    #
+    # Public
+    #
+
+    # TurboFloat server
+
+    def save_server(self, host_address, port):
+        """Saves the TurboFloat server location through the broker."""
+
+        self._call(OP_SAVE_SERVER, _PORT.pack(port) + host_address)
+
+    def get_server(self):
+        """Gets the TurboFloat Server location the broker uses."""
+
+        payload = self._call(OP_GET_SERVER)
+        port, = _PORT.unpack_from(payload)
+        return payload[_PORT.size:], port
+
+    # Set Lease Callback function
+
+    def set_callback(self, callback):
+        """
+        Set the function that is called, on a background thread, with the status
+        of every lease event relayed by the broker.
+        """
+
+        self._callback = callback
+
+    # Leases
+
+    def request_lease(self):
+        """Requests the lease from the broker."""
+
+        self.clear_feature_cache()
+        self._call(OP_REQUEST_LEASE)
+
+    def drop_lease(self):
+        """Tells the broker that this client no longer needs the lease."""
+
+        try:
+            self._call(OP_DROP_LEASE)
+        finally:
+            self.clear_feature_cache()
+
+    def has_lease(self):
+        code, _ = self._request(OP_HAS_LEASE)
+        return code == TF_OK
+
+    # Features
+
+    def has_feature(self, name):
+        return len(self.get_feature_value(name)) > 0
+
+    def get_feature_value(self, name):
+        """Gets the value of a feature from the broker."""
+
+        try:
+            return self._feature_cache[name]
+        except KeyError:
+            pass
+
+        generation = self._generation
+        value = self._call(OP_GET_FEATURE_VALUE, name)
+
+        # Checked again after storing it, like _SharedHandle.cache_feature(),
+        # in case the cache was cleared in between.
+        if self._generation == generation:
+            cache = self._feature_cache
+            cache[name] = value
+            if self._generation != generation and cache.get(name) is value:
+                cache.pop(name, None)
+
+        return value
+
+    def get_feature_values(self, names, skip_missing=False):
+        """See TurboFloat.get_feature_values()."""
+
+        values = {}
+
+        for name in names:
+            try:
+                value = self.get_feature_value(name)
+            except TurboFloatFailError:
+                if skip_missing:
+                    continue
+                raise
+
+            if value or not skip_missing:
+                values[name] = value
+
+        return values
+
+    def clear_feature_cache(self):
+        """Forgets every cached feature value."""
+
+        self._generation = next(self._generations)
+        self._feature_cache.clear()
+
+    # Utils
+
+    def is_date_valid(self, date):
+        """Check if the date is valid"""
+
+        code, _ = self._request(OP_IS_DATE_VALID, date)
+        return code == TF_OK
+
+    def clean_up(self):
+        """Closes the connections to the broker."""
+
+        for sock in (self._sock, self._events):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    #
+    # Private
+    #
+
+    def _request(self, opcode, payload=b""):
+        with self._lock:
+            _send_message(self._sock, opcode, payload)
+            return _recv_message(self._sock)
+
+    def _call(self, opcode, payload=b""):
+        code, payload = self._request(opcode, payload)
+        validate_result(code)
+        return payload
+
+    def _read_events(self):
+        while True:
+            try:
+                status, _ = _recv_message(self._events)
+            except (EOFError, OSError):
+                return
+
+            self.clear_feature_cache()
+
+            if self._callback is not None:
+                try:
+                    self._callback(status, None)
+                except Exception:
+                    traceback.print_exc()
@@ -23,25 +23,96 @@
 # IN THE SOFTWARE.
 
 import sys
+import threading
+from collections import namedtuple
 from os import path as ospath
 from ctypes import (
     cdll,
+    c_int,
     c_uint,
+    c_uint32,
+    c_ushort,
     c_void_p,
     c_char_p,
     c_wchar_p,
     Structure,
     create_string_buffer,
     create_unicode_buffer,
-    CFUNCTYPE
+    CFUNCTYPE,
+    POINTER
 )
 
+from turbofloat.recorder import flight_recorder
+
 # Utilities
 
 wbuf = create_unicode_buffer if sys.platform == "win32" else create_string_buffer
 
 wstr = c_wchar_p if sys.platform == "win32" else c_char_p
 
+
+BufferPoolInfo = namedtuple("BufferPoolInfo", ["threads", "size", "max_size"])
+
+
+class BufferPool(object):
+
+    """
+    A reusable wbuf() per thread, so reading strings from the library doesn't
+    allocate a new buffer each time. A thread's buffer grows to the largest
+    size it has been asked for, rounded up to a power of two, but never beyond
+    max_size characters; larger requests get a buffer that isn't kept.
+    """
+
+    def __init__(self, initial_size=256, max_size=65536):
+        self.initial_size = initial_size
+        self.max_size = max_size
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sizes = {}
+
+    def get(self, size=0):
+        """Returns this thread's buffer, grown to at least size characters."""
+
+        try:
+            buf = self._local.buf
+        except AttributeError:
+            buf = None
+
+        if buf is not None and len(buf) >= size:
+            return buf
+
+        if size > self.max_size:
+            return wbuf(size)
+
+        new_size = self.initial_size
+        while new_size < size:
+            new_size *= 2
+
+        buf = self._local.buf = wbuf(min(new_size, self.max_size))
+
+        with self._lock:
+            self._sizes[threading.current_thread().ident] = len(buf)
+
+        return buf
+
+    def info(self):
+        """Reports the number of threads with a buffer and their total size in characters."""
+
+        alive = set(thread.ident for thread in threading.enumerate())
+
+        with self._lock:
+            for ident in [ident for ident in self._sizes if ident not in alive]:
+                del self._sizes[ident]
+
+            return BufferPoolInfo(len(self._sizes), sum(self._sizes.values()), self.max_size)
+
+
+"""
+The buffers used to read feature values and the server address.
+"""
+buffer_pool = BufferPool()
+
 # Wrapper
 
 TF_OK = 0x00000000
@@ -122,15 +193,92 @@ The lease callback function type with a user-defined pointer.
 LeaseCallbackTypeEx = CFUNCTYPE(c_void_p, c_uint, c_void_p)
 
 
+if sys.platform == 'win32':
+    _LIBRARY_NAME = 'TurboFloat.dll'
+elif sys.platform == 'darwin':
+    _LIBRARY_NAME = 'libTurboFloat.dylib'
+else:
+    # linux, bsd, etc.
+    _LIBRARY_NAME = 'libTurboFloat.so'
+
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+# The same libraries keyed by the folder they were asked for with, which
+# saves resolving the path again.
+_libraries_by_path = {}
+
+
 def load_library(path):
+    """
+    Loads the TurboFloat library from the given folder. Each library is only
+    loaded and has its function prototypes set once per process; later calls
+    for the same file return the same object.
+    """
+
+    try:
+        return _libraries_by_path[path]
+    except KeyError:
+        pass
+
+    key = _library_key(path)
+
+    with _libraries_lock:
+        lib = _libraries.get(key)
+
+        if lib is None:
+            lib = cdll.LoadLibrary(ospath.join(path, _LIBRARY_NAME))
+            _set_prototypes(lib)
+            _libraries[key] = lib
+
+        _libraries_by_path[path] = lib
 
-    if sys.platform == 'win32':
-        return cdll.LoadLibrary(ospath.join(path, 'TurboFloat.dll'))
-    elif sys.platform == 'darwin':
-        return cdll.LoadLibrary(ospath.join(path, 'libTurboFloat.dylib'))
+    return lib
 
-    # else: linux, bsd, etc.
-    return cdll.LoadLibrary(ospath.join(path, 'libTurboFloat.so'))
+
+def _library_key(path):
+    filename = ospath.join(path, _LIBRARY_NAME)
+
+    # A bare file name is left for the dynamic linker to search for.
+    return ospath.realpath(filename) if path else filename
+
+
+def _check_result(result, func, args):
+    if result != TF_OK:
+        _raise_error(result, func.__name__)
+    return result
+
+
+"""
+The prototype of every function used from the TurboFloat library, as
+(restype, argtypes, errcheck). Functions with an errcheck raise the
+TurboFloatError matching the code they return; the others return a value
+that isn't an error code (a handle, a buffer size) or that the caller
+interprets itself (TF_HasLease).
+"""
+_PROTOTYPES = {
+    "TF_PDetsFromPath": (c_int, [wstr], _check_result),
+    "TF_GetHandle": (c_uint32, [wstr], None),
+    "TF_SaveServer": (c_int, [c_uint32, wstr, c_ushort, c_uint32], _check_result),
+    "TF_GetServer": (c_int, [c_uint32, wstr, c_int, POINTER(c_ushort)], _check_result),
+    "TF_SetLeaseCallback": (c_int, [c_uint32, LeaseCallbackType], _check_result),
+    "TF_SetLeaseCallbackEx": (c_int, [c_uint32, LeaseCallbackTypeEx, c_void_p], _check_result),
+    "TF_RequestLease": (c_int, [c_uint32], _check_result),
+    "TF_DropLease": (c_int, [c_uint32], _check_result),
+    "TF_HasLease": (c_int, [c_uint32], None),
+    "TF_GetFeatureValue": (c_int, [c_uint32, wstr, wstr, c_int], None),
+    "TF_IsDateValid": (c_int, [c_uint32, wstr, c_uint32], _check_result),
+    "TF_Cleanup": (c_int, [], _check_result),
+}
+
+
+def _set_prototypes(lib):
+    for name, (restype, argtypes, errcheck) in _PROTOTYPES.items():
+        func = getattr(lib, name)
+        func.restype = restype
+        func.argtypes = argtypes
+        if errcheck is not None:
+            func.errcheck = errcheck
 
 
 def validate_result(return_code):
@@ -138,48 +286,30 @@ def validate_result(return_code):
     if return_code == TF_OK:
         return
 
+    _raise_error(return_code)
+
+
+# The functions whose errors are recorded by the flight recorder. Feature
+# reads, date checks and loading the dat file fail as a matter of course
+# (a missing feature, an expired date, a dat file loaded already) and would
+# push the lease history out of the ring buffer.
+_RECORDED_FUNCTIONS = frozenset([
+    "TF_SaveServer", "TF_GetServer", "TF_SetLeaseCallback", "TF_SetLeaseCallbackEx",
+    "TF_RequestLease", "TF_DropLease", "TF_HasLease", "TF_Cleanup",
+])
+
+
+def _raise_error(return_code, function=None):
+    if function in _RECORDED_FUNCTIONS:
+        flight_recorder.record("error", None, function, return_code)
+
     # Raise an exception type appropriate for the kind of error
-    if return_code == TF_FAIL:
-        raise TurboFloatFailError()
-    elif return_code == TF_E_SERVER:
-        raise TurboFloatNoServerError()
-    elif return_code == TF_E_NO_CALLBACK:
-        raise TurboFloatNoCallbackError()
-    elif return_code == TF_E_INET:
-        raise TurboFloatConnectionError()
-    elif return_code == TF_E_NO_FREE_LEASES:
-        raise TurboFloatNoFreeLeaseError()
-    elif return_code == TF_E_LEASE_EXISTS:
-        raise TurboFloatLeaseAquiredError()
-    elif return_code == TF_E_WRONG_TIME:
-        raise TurboFloatTimeError()
-    elif return_code == TF_E_PDETS:
-        raise TurboFloatDatFileError()
-    elif return_code == TF_E_INVALID_HANDLE:
-        raise TurboFloatInvalidHandleError()
-    elif return_code == TF_E_NO_LEASE:
-        raise TurboFloatNoLeaseError()
-    elif return_code == TF_E_COM:
-        raise TurboFloatComError()
-    elif return_code == TF_E_INSUFFICIENT_BUFFER:
-        raise TurboFloatBufferError()
-    elif return_code == TF_E_PERMISSION:
-        raise TurboFloatPermissionError()
-    elif return_code == TF_E_INVALID_FLAGS:
-        raise TurboFloatFlagsError()
-    elif return_code == TF_E_WRONG_SERVER_PRODUCT:
-        raise TurboFloatWrongServerProductError()
-    elif return_code == TF_E_INET_TIMEOUT:
-        raise TurboFloatConnectionTimeoutError()
-    elif return_code == TF_E_UPGRADE_LIBRARY:
-        raise TurboFloatUpgradeLibraryError()
-    elif return_code == TF_E_USERNAME_NOT_ALLOWED:
-        raise TurboFloatUsernameNotAllowedError()
-    elif return_code == TF_E_ENABLE_NETWORK_ADAPTERS:
-        raise TurboFloatEnableNetworkAdaptersError()
+    error = _ERRORS.get(return_code)
+    if error is not None:
+        raise error()
 
     # Otherwise bail out and raise a generic exception
-    raise TurboActivateError(return_code)
+    raise TurboFloatError(return_code)
 
 
 #
@@ -400,8 +530,44 @@ class TurboFloatEnableNetworkAdaptersError(TurboFloatError):
     pass
 
 
+class TurboFloatFeatureDisabledError(TurboFloatError):
+
+    """
+    The function needs a feature that isn't enabled by the current lease (see
+    TurboFloat.requires_feature()). Not a TurboFloat Library error code.
+    """
+    pass
+
+
 class TurboFloatLeaseExpired(TurboFloatError):
     pass
 
 class TurboFloatFeatureChange(TurboFloatError):
     pass
+
+
+# The exception raised for each return code by validate_result().
+_ERRORS = {
+    TF_FAIL: TurboFloatFailError,
+    TF_E_SERVER: TurboFloatNoServerError,
+    TF_E_NO_CALLBACK: TurboFloatNoCallbackError,
+    TF_E_INET: TurboFloatConnectionError,
+    TF_E_NO_FREE_LEASES: TurboFloatNoFreeLeaseError,
+    TF_E_LEASE_EXISTS: TurboFloatLeaseAquiredError,
+    TF_E_WRONG_TIME: TurboFloatTimeError,
+    TF_E_PDETS: TurboFloatDatFileError,
+    TF_E_INVALID_HANDLE: TurboFloatInvalidHandleError,
+    TF_E_NO_LEASE: TurboFloatNoLeaseError,
+    TF_E_COM: TurboFloatComError,
+    TF_E_INSUFFICIENT_BUFFER: TurboFloatBufferError,
+    TF_E_PERMISSION: TurboFloatPermissionError,
+    TF_E_INVALID_FLAGS: TurboFloatFlagsError,
+    TF_E_WRONG_SERVER_PRODUCT: TurboFloatWrongServerProductError,
+    TF_E_INET_TIMEOUT: TurboFloatConnectionTimeoutError,
+    TF_E_UPGRADE_LIBRARY: TurboFloatUpgradeLibraryError,
+    TF_E_USERNAME_NOT_ALLOWED: TurboFloatUsernameNotAllowedError,
+    TF_E_ENABLE_NETWORK_ADAPTERS: TurboFloatEnableNetworkAdaptersError,
+}
+
+# The return code of each exception, the reverse of _ERRORS.
+_ERROR_CODES = dict((error, code) for code, error in _ERRORS.items())
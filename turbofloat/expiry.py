@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Calling back when dates stored in feature values pass.
+
+Rather than polling is_date_valid() for every date, an ExpiryScheduler checks
+each date with TF_IsDateValid() once, when it's registered, and then keeps it
+in a hierarchical timer wheel that a background thread advances once per
+tick. Features that are watched are read again after every lease event and
+rescheduled if their value changed:
+
+    scheduler = ExpiryScheduler(tf)
+    scheduler.watch(b"support_expires", on_support_expired)
+
+Dates are "YYYY-MM-DD hh:mm:ss" or "YYYY-MM-DD" in UTC, as for is_date_valid().
+"""
+
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from turbofloat import LEASE_ACTIVE
+from turbofloat.c_wrapper import *
+from turbofloat.snapshot import as_date
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Each level of the wheel has 2 ** _BITS slots, and _LEVELS of them cover
+# 2 ** (_BITS * _LEVELS) ticks: over 2000 years with one second ticks.
+_BITS = 6
+_SLOTS = 1 << _BITS
+_MASK = _SLOTS - 1
+_LEVELS = 6
+
+
+class Timer(object):
+
+    """A callback scheduled by a TimerWheel. See TimerWheel.schedule()."""
+
+    __slots__ = ("when", "callback", "args", "cancelled")
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+
+    """
+    A hierarchical timer wheel counting in whole ticks. Scheduling and
+    cancelling a timer are O(1), as is advancing by one tick apart from moving
+    the timers of a higher level slot down when a lower level wraps around.
+    Runs of ticks on which nothing can fire are skipped, so catching up after
+    the clock jumps forward doesn't visit each tick. Not thread safe.
+    """
+
+    def __init__(self, now=0):
+        self.now = now
+        self.count = 0
+        self._levels = [[[] for _ in range(_SLOTS)] for _ in range(_LEVELS)]
+        self._sizes = [0] * _LEVELS
+
+    def schedule(self, when, callback, *args):
+        """
+        Schedules callback(*args) for tick when, or the next tick if when has
+        passed, and returns its Timer.
+        """
+
+        timer = Timer(when, callback, args)
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def advance(self, now):
+        """Moves the wheel on to tick now and returns the timers due, in order."""
+
+        due = []
+
+        if self.count == 0:
+            # Nothing to fire, skip the empty ticks.
+            self.now = max(self.now, now)
+            return due
+
+        levels = self._levels
+        sizes = self._sizes
+
+        while self.now < now:
+            # With the lowest levels empty nothing happens until the next
+            # slot of the lowest level with timers comes round.
+            level = 0
+            while sizes[level] == 0:
+                level += 1
+            if level > 0:
+                shift = _BITS * level
+                self.now = min(now, ((self.now >> shift) + 1) << shift) - 1
+
+            self.now += 1
+            tick = self.now
+
+            # Move the timers of the higher levels down as the levels below
+            # them wrap around, highest first.
+            for level in range(_LEVELS - 1, 0, -1):
+                if tick & ((1 << (_BITS * level)) - 1) == 0:
+                    slot = levels[level][(tick >> (_BITS * level)) & _MASK]
+                    timers, slot[:] = list(slot), []
+                    sizes[level] -= len(timers)
+                    for timer in timers:
+                        self._insert(timer)
+
+            slot = levels[0][tick & _MASK]
+            timers, slot[:] = list(slot), []
+            sizes[0] -= len(timers)
+
+            for timer in timers:
+                self.count -= 1
+                if not timer.cancelled:
+                    due.append(timer)
+
+            if self.count == 0:
+                self.now = now
+                break
+
+        return due
+
+    def _insert(self, timer):
+        when = max(timer.when, self.now + 1)
+        delta = when - self.now
+
+        level = 0
+        while level < _LEVELS - 1 and delta >= 1 << (_BITS * (level + 1)):
+            level += 1
+
+        self._levels[level][(when >> (_BITS * level)) & _MASK].append(timer)
+        self._sizes[level] += 1
+
+
+def _timestamp(date):
+    return (as_date(date) - _EPOCH).total_seconds()
+
+
+class ExpiryScheduler(object):
+
+    """
+    Calls back when dates pass, advancing a TimerWheel every tick seconds on a
+    background thread, which is where the callbacks are called.
+    """
+
+    def __init__(self, tf, tick=1.0):
+        self._tf = tf
+        self._tick = tick
+
+        self._lock = threading.Lock()
+        self._watch_lock = threading.Lock()
+        self._wheel = TimerWheel(self._now())
+        self._watches = {}
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="turbofloat-expiry")
+        self._thread.daemon = True
+        self._thread.start()
+
+        self._hook = "expiry:%d" % id(self)
+        tf._shared.refresh_hooks[self._hook] = self.refresh
+
+    def add(self, date, callback):
+        """
+        Calls callback(date) once date has passed, or at the next tick if
+        is_date_valid() says it has already. Returns a Timer that can be
+        cancelled. Raises ValueError if date can't be parsed.
+        """
+
+        when = _timestamp(date)
+
+        if not self._tf.is_date_valid(date):
+            when = 0
+
+        with self._lock:
+            return self._wheel.schedule(self._ticks(when), callback, date)
+
+    def watch(self, name, callback):
+        """
+        Calls callback(name, value) once the date in the value of the feature
+        name passes. The feature is read again after every lease event and the
+        callback rescheduled if its value changed. While there's no lease, or
+        the value isn't a date, nothing is scheduled.
+        """
+
+        self.unwatch(name)
+
+        with self._watch_lock:
+            self._watches[name] = [callback, None, None]
+
+        self._reschedule(name)
+
+    def unwatch(self, name):
+        with self._watch_lock:
+            watch = self._watches.pop(name, None)
+
+            if watch is not None and watch[2] is not None:
+                watch[2].cancel()
+
+    def refresh(self):
+        """Reads the watched features again; called by the handle after every lease event."""
+
+        for name in list(self._watches):
+            self._reschedule(name)
+
+    def close(self):
+        """Stops the scheduler."""
+
+        self._tf._shared.refresh_hooks.pop(self._hook, None)
+        self._stopped.set()
+
+    #
+    # Private
+    #
+
+    def _now(self):
+        return int(time.time() // self._tick)
+
+    def _ticks(self, timestamp):
+        # The first tick at or after timestamp.
+        return -int(-timestamp // self._tick)
+
+    def _reschedule(self, name):
+        tf = self._tf
+        value = None
+
+        if tf.lease_state == LEASE_ACTIVE:
+            try:
+                value = tf.get_feature_value(name)
+            except (TurboFloatFailError, TurboFloatNoLeaseError):
+                pass
+
+        # Serialized, so a watch never ends up with two timers.
+        with self._watch_lock:
+            watch = self._watches.get(name)
+            if watch is None or watch[1] == value:
+                return
+
+            callback, _, timer = watch
+            if timer is not None:
+                timer.cancel()
+            timer = None
+
+            if value is not None:
+                try:
+                    timer = self.add(value, lambda date: callback(name, date))
+                except ValueError:
+                    pass
+
+            watch[1] = value
+            watch[2] = timer
+
+    def _run(self):
+        while not self._stopped.wait(self._tick - time.time() % self._tick):
+            with self._lock:
+                due = self._wheel.advance(self._now())
+
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    traceback.print_exc()
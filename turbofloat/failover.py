@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Choosing between several TurboFloat servers.
+
+TF_SaveServer() stores a single server. A ServerPool keeps a list of them,
+measures how long each takes to accept a TCP connection, and saves the
+fastest healthy one before requesting a lease, moving on to the next when
+the request can't reach the server:
+
+    pool = ServerPool(tf, [(b"tf1.example.com", 13), (b"tf2.example.com", 13)])
+    pool.request_lease()
+
+Each server has a circuit breaker. After failure_threshold failed requests
+or probes in a row it's skipped for reset_timeout seconds, then given one more
+chance.
+"""
+
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from turbofloat.c_wrapper import *
+
+ServerStatus = namedtuple("ServerStatus", ["host_address", "port", "latency", "state",
+                                           "failures"])
+
+# Circuit breaker states.
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# The errors that mean the server couldn't be reached.
+_CONNECTION_ERRORS = (TurboFloatConnectionError, TurboFloatConnectionTimeoutError)
+
+_now = time.monotonic
+
+
+class _Server(object):
+
+    def __init__(self, host_address, port):
+        self.host_address = host_address
+        self.port = port
+
+        # Seconds to connect at the last probe, None if it failed or there
+        # wasn't one.
+        self.latency = None
+
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def available(self, reset_timeout):
+        if self.state == OPEN and _now() - self.opened_at >= reset_timeout:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def succeeded(self):
+        self.state = CLOSED
+        self.failures = 0
+
+    def failed(self, failure_threshold):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= failure_threshold:
+            self.state = OPEN
+            self.opened_at = _now()
+
+    def status(self):
+        return ServerStatus(self.host_address, self.port, self.latency, self.state, self.failures)
+
+
+class ServerPool(object):
+
+    """
+    Requests leases for tf from the fastest reachable server of servers, a list
+    of (host_address, port). Servers are probed again every probe_interval
+    seconds, and after a request fails over.
+    """
+
+    def __init__(self, tf, servers, probe_timeout=2.0, probe_interval=300.0,
+                 failure_threshold=3, reset_timeout=30.0):
+        if not servers:
+            raise ValueError("servers is empty")
+
+        self._tf = tf
+        self._servers = [_Server(host_address, port) for host_address, port in servers]
+        self._probe_timeout = probe_timeout
+        self._probe_interval = probe_interval
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._lock = threading.RLock()
+        self._probed_at = None
+        self._current = None
+
+    @property
+    def current(self):
+        """The (host_address, port) last saved with TF_SaveServer(), or None."""
+
+        server = self._current
+        return (server.host_address, server.port) if server is not None else None
+
+    def probe(self):
+        """
+        Connects to every server at once and records how long each took.
+        Returns the status of the servers, fastest first.
+        """
+
+        servers = self._servers
+
+        with ThreadPoolExecutor(max_workers=len(servers),
+                                thread_name_prefix="turbofloat-probe") as executor:
+            latencies = list(executor.map(self._connect, servers))
+
+        with self._lock:
+            for server, latency in zip(servers, latencies):
+                server.latency = latency
+                if latency is None:
+                    server.failed(self._failure_threshold)
+                elif server.state != OPEN:
+                    server.succeeded()
+
+            self._probed_at = _now()
+
+        return self.status()
+
+    def status(self):
+        """Returns a ServerStatus for each server, fastest first."""
+
+        with self._lock:
+            return [server.status() for server in self._ranked(include_open=True)]
+
+    def request_lease(self):
+        """
+        Saves the fastest available server and requests the lease from it,
+        trying the next one each time a server can't be reached. Returns the
+        (host_address, port) that granted the lease. Raises the last connection
+        error if none could be reached; any other error is raised straight away.
+        """
+
+        with self._lock:
+            if self._probed_at is None or _now() - self._probed_at >= self._probe_interval:
+                self.probe()
+
+            candidates = self._ranked()
+            if not candidates:
+                # Every breaker is open: try them all rather than give up.
+                candidates = self._ranked(include_open=True)
+
+            error = None
+
+            for server in candidates:
+                try:
+                    self._use(server)
+                    try:
+                        self._tf.request_lease()
+                    except TurboFloatLeaseAquiredError:
+                        pass
+                except _CONNECTION_ERRORS as e:
+                    server.failed(self._failure_threshold)
+                    error = e
+                    continue
+
+                server.succeeded()
+
+                if error is not None:
+                    # Failed over, so the ranking may be out of date.
+                    self._probed_at = None
+
+                return server.host_address, server.port
+
+            raise error
+
+    #
+    # Private
+    #
+
+    def _ranked(self, include_open=False):
+        servers = [server for server in self._servers
+                   if include_open or server.available(self._reset_timeout)]
+
+        # Fastest first, then those that didn't answer the last probe, in the
+        # order given.
+        return sorted(servers, key=lambda server: (server.latency is None, server.latency or 0.0))
+
+    def _use(self, server):
+        if self._current is not server:
+            self._tf.save_server(server.host_address, server.port)
+            self._current = server
+
+    def _connect(self, server):
+        host_address = server.host_address
+        if isinstance(host_address, bytes):
+            host_address = host_address.decode("utf-8")
+
+        start = _now()
+        try:
+            socket.create_connection((host_address, server.port), self._probe_timeout).close()
+        except OSError:
+            return None
+
+        return _now() - start
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Licensing several products from one process.
+
+A TurboFloatManager holds a TurboFloat object per product and requests or
+drops all of their leases at once, on a thread pool, so starting up costs one
+server round trip instead of one per product:
+
+    manager = TurboFloatManager(callback=on_lease_event)
+    manager.add("encoder", "encoder.dat", ENCODER_GUID)
+    manager.add("decoder", "decoder.dat", DECODER_GUID)
+
+    failed = manager.request_leases(timeout=10)
+    ...
+    manager.clean_up()
+"""
+
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from turbofloat import TurboFloat, LEASE_ACTIVE, LEASE_NONE
+from turbofloat.c_wrapper import *
+
+ProductStatus = namedtuple("ProductStatus", ["dat_file", "guid", "lease_state", "error"])
+
+
+class _Product(object):
+
+    def __init__(self, name, tf, server):
+        self.name = name
+        self.tf = tf
+        self.server = server
+        self.ready = False
+        self.error = None
+
+
+class TurboFloatManager(object):
+
+    """
+    Manages the leases of several products, each with its own dat file and GUID.
+
+    callback, if given, is called with the product name, the status and the
+    context of every lease event of every product.
+    """
+
+    def __init__(self, library_folder="", mode=TF_USER, callback=None, max_workers=None):
+        self._library_folder = library_folder
+        self._mode = mode
+        self._callback = callback
+        self._max_workers = max_workers
+
+        self._lock = threading.Lock()
+        self._products = {}
+
+    def add(self, name, dat_file, guid, host_address=None, port=None, library_folder=None):
+        """
+        Adds a product and returns its TurboFloat object. Nothing is loaded until
+        the first request_leases(), which also saves host_address and port as the
+        product's server if they're given.
+        """
+
+        if library_folder is None:
+            library_folder = self._library_folder
+
+        tf = TurboFloat(dat_file, guid, library_folder, self._mode, lazy=True)
+        server = (host_address, port) if host_address is not None else None
+
+        with self._lock:
+            if name in self._products:
+                raise ValueError("product %r already added" % (name,))
+            self._products[name] = _Product(name, tf, server)
+
+        return tf
+
+    def __getitem__(self, name):
+        return self._products[name].tf
+
+    def __contains__(self, name):
+        return name in self._products
+
+    def __iter__(self):
+        return iter(list(self._products))
+
+    def __len__(self):
+        return len(self._products)
+
+    def request_leases(self, names=None, timeout=None):
+        """
+        Requests the leases of the named products (all by default) concurrently
+        and waits at most timeout seconds in total. Returns a dict of the products
+        that didn't get a lease, mapping each name to the error raised; those still
+        waiting for the server when timeout expires map to
+        TurboFloatConnectionTimeoutError and get their lease in the background if
+        the server answers later. Products that already have a lease are left alone.
+        """
+
+        return self._run(self._request_lease, names, timeout)
+
+    def drop_leases(self, names=None, timeout=None):
+        """
+        Drops the leases of the named products (all by default) concurrently.
+        Returns a dict of the products whose lease couldn't be dropped, like
+        request_leases(). Products without a lease are left alone.
+        """
+
+        return self._run(self._drop_lease, names, timeout)
+
+    def has_leases(self, names=None):
+        """Whether every named product (all by default) has a lease."""
+
+        return all(self._products[name].tf.lease_state == LEASE_ACTIVE
+                   for name in self._names(names))
+
+    def status(self):
+        """
+        Returns a dict mapping each product name to a ProductStatus with its dat
+        file, GUID, lease state and the error of the last failed lease request or
+        drop (None if it succeeded).
+        """
+
+        status = {}
+
+        for name, product in list(self._products.items()):
+            tf = product.tf
+            lease_state = tf.lease_state if product.ready else LEASE_NONE
+            status[name] = ProductStatus(tf._dat_file, tf._guid, lease_state, product.error)
+
+        return status
+
+    def clean_up(self, timeout=None):
+        """
+        Drops every lease, then calls TF_Cleanup() once for each library the
+        products use. Returns the errors of drop_leases(). The manager can't be
+        used afterwards.
+
+        A library with a drop still running when timeout expires isn't cleaned
+        up, since TF_Cleanup() would free the handle the drop is using.
+        """
+
+        running = []
+        errors = self._run(self._drop_lease, None, timeout, running)
+
+        # Never cleaned: a drop is still using them.
+        cleaned = set(product.tf._lib for product in running)
+
+        for product in list(self._products.values()):
+            tf = product.tf
+            if not product.ready or tf._lib in cleaned:
+                continue
+
+            cleaned.add(tf._lib)
+            try:
+                tf.clean_up()
+            except TurboFloatError as e:
+                errors.setdefault(product.name, e)
+
+        for product in self._products.values():
+            product.ready = False
+
+        return errors
+
+    #
+    # Private
+    #
+
+    def _names(self, names):
+        return list(self._products) if names is None else list(names)
+
+    def _run(self, func, names, timeout, running=None):
+        # The products whose calls are still running at timeout are appended
+        # to running, if it's given.
+        products = [self._products[name] for name in self._names(names)]
+        if not products:
+            return {}
+
+        executor = ThreadPoolExecutor(max_workers=self._max_workers or len(products),
+                                      thread_name_prefix="turbofloat-manager")
+        try:
+            futures = dict((executor.submit(func, product), product) for product in products)
+            done, pending = wait(futures, timeout)
+        finally:
+            executor.shutdown(wait=False)
+
+        errors = {}
+
+        for future, product in futures.items():
+            if future in pending:
+                errors[product.name] = TurboFloatConnectionTimeoutError()
+                if running is not None:
+                    running.append(product)
+                continue
+
+            error = future.exception()
+            if error is not None:
+                errors[product.name] = error
+
+        return errors
+
+    def _prepare(self, product):
+        # Runs in the pool, so loading the dat files happens in parallel too.
+        if product.ready:
+            return
+
+        tf = product.tf
+        tf.set_callback(lambda status, context: self._on_lease_event(product.name, status, context))
+
+        if product.server is not None:
+            tf.save_server(*product.server)
+
+        product.ready = True
+
+    def _request_lease(self, product):
+        try:
+            self._prepare(product)
+
+            if product.tf.lease_state != LEASE_ACTIVE:
+                try:
+                    product.tf.request_lease()
+                except TurboFloatLeaseAquiredError:
+                    pass
+        except TurboFloatError as e:
+            product.error = e
+            raise e
+
+        product.error = None
+
+    def _drop_lease(self, product):
+        if not product.ready:
+            return
+
+        try:
+            product.tf.drop_lease()
+        except TurboFloatNoLeaseError:
+            pass
+        except TurboFloatError as e:
+            product.error = e
+            raise e
+
+        product.error = None
+
+    def _on_lease_event(self, name, status, context):
+        if self._callback is not None:
+            self._callback(name, status, context)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Call counts, errors and latency histograms for the TurboFloat library calls.
+
+Metrics are collected per handle once TurboFloat.enable_metrics() is called;
+until then the library functions are called directly and cost nothing extra.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from turbofloat.c_wrapper import TurboFloatBufferError, TurboFloatError
+
+"""
+The default upper bounds, in seconds, of the latency histogram buckets. Calls
+that only touch the library take microseconds, those that reach the server
+take milliseconds to seconds.
+"""
+DEFAULT_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_now = time.perf_counter
+
+# A TF_E_INSUFFICIENT_BUFFER only means the pooled buffer was too small and
+# the call is made again with a bigger one, so it's counted as a buffer miss
+# rather than an error.
+_BUFFER_MISS = TurboFloatBufferError.__name__
+
+
+class _Series(object):
+
+    """
+    The counters of one function, a fixed array of histogram buckets plus errors
+    and buffer misses.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.errors = {}
+        self.buffer_misses = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, error=None):
+        index = bisect_left(self.buckets, seconds)
+
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+            if error == _BUFFER_MISS:
+                self.buffer_misses += 1
+            elif error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+            errors = dict(self.errors)
+            buffer_misses = self.buffer_misses
+
+        cumulative = []
+        count = 0
+        for bound, bucket in zip(list(self.buckets) + [float("inf")], counts):
+            count += bucket
+            cumulative.append((bound, count))
+
+        return {
+            "calls": count,
+            "errors": errors,
+            "buffer_misses": buffer_misses,
+            "sum_seconds": total,
+            "buckets": cumulative,
+        }
+
+
+class Metrics(object):
+
+    """The metrics of one TurboFloat handle, keyed by library function name."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def series(self, name):
+        try:
+            return self._series[name]
+        except KeyError:
+            with self._lock:
+                return self._series.setdefault(name, _Series(self.buckets))
+
+    def observe(self, name, seconds, error=None):
+        """Records one call to name that took seconds and raised error (a class name)."""
+
+        self.series(name).observe(seconds, error)
+
+    def instrument(self, name, func, check=None):
+        """
+        Wraps func so every call is recorded under name. Calls raising a
+        TurboFloatError count as errors of that class, except
+        TurboFloatBufferError, which counts as a buffer miss; check, if given,
+        is called with the result and the arguments of calls that return and
+        returns the name of the error the result stands for, or None.
+        """
+
+        observe = self.series(name).observe
+
+        def call(*args):
+            start = _now()
+            try:
+                result = func(*args)
+            except TurboFloatError as e:
+                observe(_now() - start, type(e).__name__)
+                raise
+
+            observe(_now() - start, check(result, args) if check is not None else None)
+            return result
+
+        call.__name__ = name
+        return call
+
+    def snapshot(self):
+        """
+        Returns the metrics as a dict of function name to a dict of calls,
+        errors (by exception class name), buffer_misses, sum_seconds and
+        buckets, a list of (upper bound, cumulative count) pairs.
+        """
+
+        with self._lock:
+            series = dict(self._series)
+
+        return dict((name, s.snapshot()) for name, s in series.items())
+
+    def prometheus(self, prefix="turbofloat"):
+        """Returns the metrics in the Prometheus text exposition format."""
+
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP %s_call_duration_seconds Time spent in TurboFloat library calls." % prefix,
+            "# TYPE %s_call_duration_seconds histogram" % prefix,
+        ]
+
+        for name in sorted(snapshot):
+            series = snapshot[name]
+            for bound, count in series["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_call_duration_seconds_bucket{function="%s",le="%s"} %d'
+                             % (prefix, name, le, count))
+            lines.append('%s_call_duration_seconds_sum{function="%s"} %r'
+                         % (prefix, name, series["sum_seconds"]))
+            lines.append('%s_call_duration_seconds_count{function="%s"} %d'
+                         % (prefix, name, series["calls"]))
+
+        lines.append("# HELP %s_call_errors_total TurboFloat library calls that failed." % prefix)
+        lines.append("# TYPE %s_call_errors_total counter" % prefix)
+
+        for name in sorted(snapshot):
+            errors = snapshot[name]["errors"]
+            for error in sorted(errors):
+                lines.append('%s_call_errors_total{function="%s",error="%s"} %d'
+                             % (prefix, name, error, errors[error]))
+
+        lines.append("# HELP %s_buffer_misses_total TurboFloat library calls made again "
+                     "with a bigger buffer." % prefix)
+        lines.append("# TYPE %s_buffer_misses_total counter" % prefix)
+
+        for name in sorted(snapshot):
+            misses = snapshot[name]["buffer_misses"]
+            if misses:
+                lines.append('%s_buffer_misses_total{function="%s"} %d' % (prefix, name, misses))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+A flight recorder of lease activity.
+
+Every lease request and drop, every lease callback status and every error code
+returned by the library's lease and server functions is recorded in a
+fixed-size ring buffer, so when a lease was lost the events leading up to it
+can be dumped afterwards. Errors from feature reads and date checks aren't
+recorded, since they're routine and would push the lease events out:
+
+    from turbofloat import flight_recorder
+    flight_recorder.dump(open("turbofloat-events.jsonl", "w"))
+
+or, from outside the process, after install_signal_handler():
+
+    kill -USR2 <pid>
+
+Each event is one JSON object per line with its wall clock and monotonic
+time in seconds, the event and, where they apply, the handle, the duration of
+the call in seconds, the return code or callback status, the function that
+returned an error and the error or status name.
+"""
+
+import json
+import sys
+import time
+from itertools import count
+from operator import itemgetter
+
+"""The number of events kept by default."""
+DEFAULT_SIZE = 4096
+
+_monotonic_ns = time.monotonic_ns
+
+_STATUSES = {
+    0x00000000: "TF_CB_EXPIRED",
+    0x00000001: "TF_CB_EXPIRED_INET",
+    0x00000002: "TF_CB_FEATURES_CHANGED",
+}
+
+
+class FlightRecorder(object):
+
+    """
+    Keeps the last size events. Recording one costs a clock read, a tuple and
+    a list store, and takes no lock.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.enabled = True
+
+        self._size = size
+        self._events = [None] * size
+        self._sequence = count()
+
+    @property
+    def size(self):
+        return self._size
+
+    def record(self, event, handle=None, detail=None, code=None, duration=None):
+        """
+        Records an event. detail is a name (the error, or the function that
+        returned code), code a return code or callback status and duration the
+        seconds the call took.
+        """
+
+        if self.enabled:
+            sequence = next(self._sequence)
+            self._events[sequence % self._size] = (
+                sequence, _monotonic_ns(), event, handle, detail, code, duration)
+
+    def clear(self):
+        self._events = [None] * self._size
+
+    def events(self):
+        """Returns the recorded events, oldest first, as a list of dicts."""
+
+        from turbofloat.c_wrapper import _ERRORS
+
+        # Sorted on the sequence number alone: events recorded in the same
+        # nanosecond can't be compared on the rest of their fields.
+        recorded = sorted((e for e in list(self._events) if e is not None),
+                          key=itemgetter(0))
+        offset = time.time() - _monotonic_ns() * 1e-9
+
+        events = []
+
+        for _, timestamp, event, handle, detail, code, duration in recorded:
+            monotonic = timestamp * 1e-9
+            record = {"time": offset + monotonic, "monotonic": monotonic, "event": event}
+
+            if handle is not None:
+                record["handle"] = handle
+            if code is not None:
+                record["code"] = code
+                if event == "callback":
+                    detail = _STATUSES.get(code, "unknown")
+                elif event == "error":
+                    record["error"] = _ERRORS.get(code, Exception).__name__
+            if detail is not None:
+                record["detail"] = detail
+            if duration is not None:
+                record["duration"] = duration
+
+            events.append(record)
+
+        return events
+
+    def dump(self, file=None):
+        """Writes the recorded events to file (stderr by default) as JSON lines."""
+
+        if file is None:
+            file = sys.stderr
+
+        for record in self.events():
+            file.write(json.dumps(record, sort_keys=True) + "\n")
+        file.flush()
+
+    def install_signal_handler(self, signum=None, path=None):
+        """
+        Dumps the events whenever the process receives signum (SIGUSR2 by
+        default), appending them to the file at path or writing them to stderr.
+        Returns the previous handler. Must be called from the main thread.
+        """
+
+        import signal
+
+        if signum is None:
+            signum = signal.SIGUSR2
+
+        def handler(signum, frame):
+            if path is None:
+                self.dump()
+            else:
+                with open(path, "a") as f:
+                    self.dump(f)
+
+        return signal.signal(signum, handler)
+
+
+"""The flight recorder used by every TurboFloat handle."""
+flight_recorder = FlightRecorder()
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Sharing feature values with forked worker processes through shared memory.
+
+The process that holds the lease publishes the values of a set of features,
+and the lease state, to a memory-mapped file after every lease event. Worker
+processes open a read-only FeatureTableView of the file, which has the same
+feature methods as TurboFloat but makes no library calls:
+
+    # In the parent process, e.g. in gunicorn's on_starting hook
+    publisher = FeatureTablePublisher(tf, "/dev/shm/myapp-features", [b"seats", b"edition"])
+
+    # In each worker
+    features = FeatureTableView("/dev/shm/myapp-features")
+    if features.has_feature(b"edition"):
+        ...
+
+The table is guarded by a sequence lock: the publisher makes the sequence
+number odd while it writes and even again when it's done, and a reader keeps
+the values it copied only if the sequence number was the same even number
+before and after copying them. Readers never block the publisher and never
+see a half written table.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+from turbofloat import LEASE_ACTIVE, LEASE_EXPIRED, LEASE_NONE
+from turbofloat.c_wrapper import *
+
+_MAGIC = b"TFFT"
+_LAYOUT = 1
+
+# magic, layout, sequence number, generation, lease state, text values,
+# count of features, length of the entries
+_HEADER = struct.Struct("<4sIQQBBxxII")
+_SEQUENCE = struct.Struct("<Q")
+_SEQUENCE_OFFSET = 8
+
+# length of the name, length of the value, then the name and value
+_ENTRY = struct.Struct("<HI")
+
+_LEASE_STATES = (LEASE_NONE, LEASE_ACTIVE, LEASE_EXPIRED)
+
+"""The default size of the table file, in bytes."""
+DEFAULT_TABLE_SIZE = 65536
+
+# How long a view waits for the publisher to finish writing the table before
+# it gives up and keeps the last table it read. A publisher that died while
+# writing leaves the sequence number odd for good.
+_WRITE_WAIT = 1.0
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+class FeatureTablePublisher(object):
+
+    """
+    Writes the values of names, read through tf, and tf's lease state to the
+    file at path after every lease event of tf's handle, and once straight away.
+    """
+
+    def __init__(self, tf, path, names, size=DEFAULT_TABLE_SIZE):
+        if size <= _HEADER.size:
+            raise ValueError("size must be more than %d bytes" % _HEADER.size)
+
+        self._tf = tf
+        self._path = path
+        self._names = list(names)
+        self._size = size
+
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+        # The handle published last and the generation it was at. Generations
+        # start again for a handle loaded after clean_up(), so the generation
+        # is only compared for the same handle.
+        self._shared = None
+        self._generation = -1
+
+        # Written under a temporary name and renamed, so a reader never opens
+        # a file without a header.
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+        _HEADER.pack_into(self._map, 0, _MAGIC, _LAYOUT, 0, 0, 0, 0, 0, 0)
+        os.rename(temp_path, path)
+
+        self._hook = "feature_table:%s" % path
+        self.publish()
+
+    @property
+    def path(self):
+        return self._path
+
+    def publish(self):
+        """
+        Writes the current values to the table. Called by the handle after every
+        lease event; raises ValueError if they don't fit in the file.
+        """
+
+        tf = self._tf
+        shared = tf._shared
+        generation = shared.generation
+        lease_state = shared.lease_state
+
+        if shared is not self._shared:
+            with self._lock:
+                if self._map is None:
+                    return
+
+                if self._shared is not None:
+                    self._shared.refresh_hooks.pop(self._hook, None)
+                shared.refresh_hooks[self._hook] = self.publish
+
+                self._shared = shared
+                self._generation = -1
+
+        values = []
+        text = 0
+
+        if lease_state == LEASE_ACTIVE:
+            for name in self._names:
+                try:
+                    value = tf.get_feature_value(name)
+                except (TurboFloatFailError, TurboFloatNoLeaseError):
+                    continue
+
+                if not isinstance(value, bytes):
+                    text = 1
+                values.append((_encode(name), _encode(value)))
+
+        entries = b"".join(_ENTRY.pack(len(name), len(value)) + name + value
+                           for name, value in values)
+
+        if _HEADER.size + len(entries) > self._size:
+            raise ValueError("the features need %d bytes, the table has %d"
+                             % (_HEADER.size + len(entries), self._size))
+
+        with self._lock:
+            if self._map is None or shared is not self._shared or generation < self._generation:
+                return
+
+            table = self._map
+            sequence = self._sequence
+
+            _SEQUENCE.pack_into(table, _SEQUENCE_OFFSET, sequence + 1)
+            table[_HEADER.size:_HEADER.size + len(entries)] = entries
+            _HEADER.pack_into(table, 0, _MAGIC, _LAYOUT, sequence + 1, generation,
+                              _LEASE_STATES.index(lease_state), text, len(values), len(entries))
+            _SEQUENCE.pack_into(table, _SEQUENCE_OFFSET, sequence + 2)
+
+            self._sequence = sequence + 2
+            self._generation = generation
+
+    def close(self, unlink=True):
+        """
+        Stops publishing and, with unlink, removes the file. Views that still
+        have the removed file open then see no lease rather than the last values.
+        """
+
+        with self._lock:
+            if self._shared is not None:
+                self._shared.refresh_hooks.pop(self._hook, None)
+
+            table, self._map = self._map, None
+
+            if table is not None and unlink:
+                sequence = self._sequence
+                _SEQUENCE.pack_into(table, _SEQUENCE_OFFSET, sequence + 1)
+                _HEADER.pack_into(table, 0, _MAGIC, _LAYOUT, sequence + 1, max(self._generation, 0),
+                                  _LEASE_STATES.index(LEASE_NONE), 0, 0, 0)
+                _SEQUENCE.pack_into(table, _SEQUENCE_OFFSET, sequence + 2)
+                self._sequence = sequence + 2
+
+        if table is not None:
+            table.close()
+
+        if unlink:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+
+
+class FeatureTableView(object):
+
+    """
+    A read-only view of a table written by a FeatureTablePublisher, with the
+    feature methods of TurboFloat. The values are decoded once per change of the
+    table; other calls only read its sequence number. If the publisher doesn't
+    finish writing the table within a second, the last table read is used until
+    it does, with no lease if none was read yet.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, layout = _HEADER.unpack_from(self._map, 0)[:2]
+        if magic != _MAGIC or layout != _LAYOUT:
+            self._map.close()
+            raise ValueError("%s isn't a feature table" % path)
+
+        # (sequence number, generation, lease state, values)
+        self._table = (-1, 0, LEASE_NONE, {})
+
+        # The sequence number of a write that _copy() gave up waiting for.
+        self._stalled = None
+
+    # Leases
+
+    def has_lease(self):
+        return self._read()[2] == LEASE_ACTIVE
+
+    @property
+    def lease_state(self):
+        """The lease state of the publisher's handle, see TurboFloat.lease_state."""
+
+        return self._read()[2]
+
+    @property
+    def feature_generation(self):
+        """The generation of the lease event the table was written for."""
+
+        return self._read()[1]
+
+    # Features
+
+    def has_feature(self, name):
+        return len(self.get_feature_value(name)) > 0
+
+    def get_feature_value(self, name):
+        """
+        Gets the value of a feature. Raises TurboFloatNoLeaseError if the publisher
+        has no lease and TurboFloatFailError if the feature wasn't published.
+        """
+
+        _, _, lease_state, values = self._read()
+
+        if lease_state != LEASE_ACTIVE:
+            raise TurboFloatNoLeaseError()
+
+        try:
+            return values[name]
+        except KeyError:
+            raise TurboFloatFailError()
+
+    def get_feature_values(self, names, skip_missing=False):
+        """See TurboFloat.get_feature_values()."""
+
+        _, _, lease_state, table = self._read()
+
+        if lease_state != LEASE_ACTIVE:
+            raise TurboFloatNoLeaseError()
+
+        values = {}
+
+        for name in names:
+            try:
+                value = table[name]
+            except KeyError:
+                if skip_missing:
+                    continue
+                raise TurboFloatFailError()
+
+            if value or not skip_missing:
+                values[name] = value
+
+        return values
+
+    def close(self):
+        self._map.close()
+
+    #
+    # Private
+    #
+
+    def _read(self):
+        table = self._table
+        sequence, = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)
+
+        if sequence == table[0] or sequence == self._stalled:
+            return table
+
+        table = self._table = self._copy()
+        return table
+
+    def _copy(self):
+        view = self._map
+        deadline = None
+
+        while True:
+            sequence, = _SEQUENCE.unpack_from(view, _SEQUENCE_OFFSET)
+            if sequence & 1:
+                # Being written.
+                if deadline is None:
+                    deadline = time.monotonic() + _WRITE_WAIT
+                elif time.monotonic() >= deadline:
+                    self._stalled = sequence
+                    return self._table
+
+                time.sleep(0)
+                continue
+
+            header = _HEADER.unpack_from(view, 0)
+            entries = view[_HEADER.size:_HEADER.size + header[7]]
+
+            if _SEQUENCE.unpack_from(view, _SEQUENCE_OFFSET)[0] == sequence == header[2]:
+                break
+
+        _, _, _, generation, lease_state, text, count, _ = header
+
+        values = {}
+        offset = 0
+
+        for _ in range(count):
+            name_size, value_size = _ENTRY.unpack_from(entries, offset)
+            offset += _ENTRY.size
+            name = entries[offset:offset + name_size]
+            offset += name_size
+            value = entries[offset:offset + value_size]
+            offset += value_size
+
+            if text:
+                name = name.decode("utf-8")
+                value = value.decode("utf-8")
+            values[name] = value
+
+        return sequence, generation, _LEASE_STATES[lease_state], values
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Immutable, decoded views of a handle's feature values.
+
+A FeatureSnapshot is built once per lease event from a schema that maps
+feature names to decoders, and is swapped in as a whole, so threads reading
+it never take a lock or call into the library:
+
+    tf.set_feature_schema({b"seats": as_int, b"pro": as_bool, b"expires": as_date})
+    ...
+    snapshot = tf.feature_snapshot
+    if snapshot.get(b"pro"):
+        ...
+"""
+
+from datetime import datetime
+
+_DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+_TRUE = frozenset(["1", "true", "yes", "on"])
+_FALSE = frozenset(["", "0", "false", "no", "off"])
+
+
+def _text(value):
+    # Feature values are bytes where the library takes char strings and str
+    # where it takes wide strings.
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+def as_str(value):
+    """Decodes a feature value to str."""
+
+    return _text(value)
+
+
+def as_int(value):
+    """Decodes a feature value to int."""
+
+    return int(_text(value).strip())
+
+
+def as_bool(value):
+    """
+    Decodes a feature value to bool. "1", "true", "yes" and "on" are True and
+    "0", "false", "no", "off" and the empty string are False, in any case.
+    """
+
+    text = _text(value).strip().lower()
+
+    if text in _TRUE:
+        return True
+    if text in _FALSE:
+        return False
+
+    raise ValueError("not a boolean: %r" % (value,))
+
+
+def as_date(value):
+    """Decodes a "YYYY-MM-DD hh:mm:ss" or "YYYY-MM-DD" feature value to a datetime."""
+
+    text = _text(value).strip()
+
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError("not a date: %r" % (value,))
+
+
+class FeatureSnapshot(object):
+
+    """
+    The decoded feature values of a handle at one lease event.
+
+    generation is the number of the lease event the snapshot was built for;
+    it's behind TurboFloat.feature_generation while a newer snapshot is being
+    built. Features that don't exist, or couldn't be read because there's no
+    lease, are missing, and those whose decoder raised are in errors.
+    """
+
+    __slots__ = ("generation", "lease_state", "errors", "_values")
+
+    def __init__(self, generation, lease_state, values, errors=None):
+        object.__setattr__(self, "generation", generation)
+        object.__setattr__(self, "lease_state", lease_state)
+        object.__setattr__(self, "errors", dict(errors or {}))
+        object.__setattr__(self, "_values", dict(values))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FeatureSnapshot is immutable")
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "FeatureSnapshot(generation=%r, lease_state=%r, values=%r)" % (
+            self.generation, self.lease_state, self._values)
+
+    def get(self, name, default=None):
+        return self._values.get(name, default)
+
+    def items(self):
+        return self._values.items()
+
+    def as_dict(self):
+        """Returns a copy of the decoded values."""
+
+        return dict(self._values)
+
+
+def build_snapshot(generation, lease_state, schema, read):
+    """
+    Builds a FeatureSnapshot by decoding read(name) for every name in schema.
+    read raises KeyError for a feature that doesn't exist.
+    """
+
+    values = {}
+    errors = {}
+
+    for name, decode in schema.items():
+        try:
+            raw = read(name)
+        except KeyError:
+            continue
+
+        try:
+            values[name] = decode(raw) if decode is not None else raw
+        except Exception as e:
+            errors[name] = e
+
+    return FeatureSnapshot(generation, lease_state, values, errors)
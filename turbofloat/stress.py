@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Concurrency stress and fault injection against turbofloat.testing.FakeLibrary.
+
+Runs many worker threads, each with its own GUID and so its own handle, that
+acquire a lease, read features and drop the lease in a loop. Meanwhile the
+fake library adds latency, fails a share of the calls and fires storms of
+lease callbacks. For example, 200 workers with 50 seats and a slow,
+unreliable server:
+
+    python -m turbofloat.stress -w 200 --seats 50 --latency 0.02 \
+        --fault TF_RequestLease:TF_E_INET:0.05 --storm-rate 50
+
+With --handles fewer than the workers, the workers share the handles, each
+with its own TurboFloat object, so the feature cache, the acquire_lease()
+queue and the callback dispatcher of a handle are used by many threads at
+once. Those workers keep the lease rather than dropping it each time: half
+call acquire_lease() when they find it lost and half read inside lease()
+scopes. With --processes the test runs in that many processes at once, each
+with its own fake library.
+
+The report has, per operation, the number of calls, the throughput and the
+latency percentiles, the errors by class, and the correctness checks: more
+leases held at once than there are seats, feature values that were never
+published or older than one already published when the read started, errors
+other than TurboFloatError and leases left behind.
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+import turbofloat
+from turbofloat import TurboFloat, LEASE_ACTIVE
+from turbofloat.c_wrapper import *
+from turbofloat.testing import FakeLibrary, install, uninstall
+
+_LIBRARY_FOLDER = "turbofloat-stress"
+_DAT_FILE = b"TurboActivate.dat"
+_FEATURE = b"edition"
+
+_now = time.perf_counter
+
+"""The default share of callbacks in a storm that report an expired lease."""
+DEFAULT_EXPIRE_SHARE = 0.05
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _version(value):
+    # Published values are b"edition-<version>".
+    return int(value.rsplit(b"-", 1)[1])
+
+
+class _Worker(threading.Thread):
+
+    def __init__(self, number, handle, shared, ready, stop, timeout, published):
+        threading.Thread.__init__(self, name="turbofloat-stress-%d" % number)
+        self.daemon = True
+
+        self.guid = ("stress-%d" % handle).encode("ascii")
+        self.shared = shared
+        self.scoped = shared and number % 2 == 1
+        self.ready = ready
+        self.stop = stop
+        self.timeout = timeout
+
+        # The version of the last feature value whose callback has returned;
+        # a read that starts after that mustn't return an older one.
+        self.published = published
+
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.unexpected = []
+        self.values = set()
+        self.stale = 0
+        self.callbacks = 0
+
+    def run(self):
+        # Every worker gets its handle before any starts the load, which would
+        # otherwise starve the threads still setting up.
+        try:
+            tf = TurboFloat(_DAT_FILE, self.guid, _LIBRARY_FOLDER)
+            tf.save_server(b"127.0.0.1", 13)
+            tf.set_callback(self._on_lease_event)
+        except Exception:
+            self.unexpected.append(traceback.format_exc())
+            tf = None
+
+        self.ready.wait()
+        if tf is None:
+            return
+
+        try:
+            while not self.stop.is_set():
+                if self.shared:
+                    # Cached reads never wait on the fake, so the GIL is given
+                    # up here for the storm thread to keep to its rate.
+                    time.sleep(0)
+
+                if self.scoped:
+                    self._call("lease_scope", self._read_in_scope, tf)
+                    continue
+
+                if not self.shared or not tf.has_lease():
+                    self._call("acquire_lease", tf.acquire_lease, self.timeout, 0.001, 0.05)
+                    if not tf.has_lease():
+                        continue
+
+                self._read(tf)
+
+                if not self.shared:
+                    self._call("drop_lease", tf.drop_lease)
+
+            # The faults are cleared once stopped, so a lease still held after
+            # a failed drop is only left behind if the binding lost track of it.
+            for _ in range(10):
+                if tf.lease_state != LEASE_ACTIVE:
+                    break
+                try:
+                    tf.drop_lease()
+                except TurboFloatNoLeaseError:
+                    break
+                except TurboFloatError:
+                    pass
+        except Exception:
+            self.unexpected.append(traceback.format_exc())
+
+    def _read(self, tf):
+        floor = self.published[0]
+
+        value = self._call("get_feature_value", tf.get_feature_value, _FEATURE)
+        if value is not None:
+            self.values.add(value)
+            if _version(value) < floor:
+                self.stale += 1
+
+    def _read_in_scope(self, tf):
+        with tf.lease():
+            self._read(tf)
+
+    def _call(self, name, func, *args):
+        start = _now()
+        try:
+            return func(*args)
+        except TurboFloatError as e:
+            self.errors[(name, type(e).__name__)] += 1
+        finally:
+            self.samples[name].append(_now() - start)
+
+    def _on_lease_event(self, status, context):
+        self.callbacks += 1
+
+
+def _storm(lib, stop, rate, expire_share, rng, published, latest):
+    """Fires lease callbacks at random handles rate times a second until stop is set."""
+
+    fired = 0
+    interval = 1.0 / rate
+    version = 0
+
+    while not stop.wait(interval):
+        if rng.random() < expire_share:
+            status = rng.choice((TF_CB_EXPIRED, TF_CB_EXPIRED_INET))
+            leases = list(lib._leases)
+            if leases:
+                lib.fire(status, rng.choice(leases))
+        else:
+            version += 1
+            value = ("edition-%d" % version).encode("ascii")
+            published.add(value)
+            lib.features = {_FEATURE: value}
+            lib.fire(TF_CB_FEATURES_CHANGED)
+            latest[0] = version
+
+        fired += 1
+
+    return fired
+
+
+def run(workers=100, duration=5.0, seats=None, latency=0.0, jitter=0.0, faults=(),
+        storm_rate=0.0, expire_share=DEFAULT_EXPIRE_SHARE, timeout=1.0, seed=None,
+        handles=None, processes=1):
+    """
+    Runs the stress test and returns the report as a dict. faults is a list of
+    (function name, return code, rate) to inject; latency and jitter apply to
+    the functions that reach the server. The workers share handles handles
+    (one each if None). With processes above 1, each process runs workers
+    workers and the report has each one's report under "processes".
+    """
+
+    if processes > 1:
+        return _run_processes(processes, dict(
+            workers=workers, duration=duration, seats=seats, latency=latency, jitter=jitter,
+            faults=faults, storm_rate=storm_rate, expire_share=expire_share,
+            timeout=timeout, seed=seed, handles=handles))
+
+    handles = workers if handles is None else max(1, min(handles, workers))
+    shared = handles < workers
+
+    rng = random.Random(seed)
+    published = set([b"edition-0"])
+    latest = [0]
+
+    uninstall(_LIBRARY_FOLDER)
+    lib = install(FakeLibrary(features={_FEATURE: b"edition-0"}, seats=seats), _LIBRARY_FOLDER)
+    lib.seed(seed)
+
+    for name in ("TF_RequestLease", "TF_DropLease"):
+        lib.set_latency(name, latency, jitter)
+    for name, code, rate in faults:
+        lib.inject(name, code, rate)
+
+    ready = threading.Barrier(workers + 1)
+    stop = threading.Event()
+    threads = [_Worker(number, number % handles, shared, ready, stop, timeout, latest)
+               for number in range(workers)]
+
+    storm = {}
+    if storm_rate > 0:
+        storm_thread = threading.Thread(
+            target=lambda: storm.update(fired=_storm(lib, stop, storm_rate, expire_share,
+                                                     rng, published, latest)),
+            name="turbofloat-stress-storm")
+        storm_thread.daemon = True
+    else:
+        storm_thread = None
+
+    try:
+        start = _now()
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        setup = _now() - start
+
+        start = _now()
+        if storm_thread is not None:
+            storm_thread.start()
+
+        stop.wait(duration)
+        stop.set()
+        lib.clear_faults()
+
+        for thread in threads:
+            thread.join()
+        if storm_thread is not None:
+            storm_thread.join()
+        elapsed = _now() - start
+
+        left_behind = len(lib._leases)
+    finally:
+        uninstall(_LIBRARY_FOLDER)
+
+    operations = {}
+    for name in ("acquire_lease", "lease_scope", "get_feature_value", "drop_lease"):
+        samples = sorted(s for thread in threads for s in thread.samples[name])
+        if not samples:
+            continue
+
+        operations[name] = {
+            "calls": len(samples),
+            "ops_per_sec": len(samples) / elapsed,
+            "p50_ms": _percentile(samples, 0.50) * 1e3,
+            "p99_ms": _percentile(samples, 0.99) * 1e3,
+            "p999_ms": _percentile(samples, 0.999) * 1e3,
+            "max_ms": samples[-1] * 1e3,
+        }
+
+    errors = defaultdict(int)
+    for thread in threads:
+        for (name, error), n in thread.errors.items():
+            errors["%s: %s" % (name, error)] += n
+
+    unexpected = [trace for thread in threads for trace in thread.unexpected]
+    unpublished = set(value for thread in threads for value in thread.values) - published
+    stale = sum(thread.stale for thread in threads)
+
+    violations = []
+    if seats is not None and lib.peak_leases > seats:
+        violations.append("%d leases held at once with %d seats" % (lib.peak_leases, seats))
+    if unpublished:
+        violations.append("read unpublished feature values: %r" % sorted(unpublished))
+    if stale:
+        violations.append("%d reads returned a feature value older than the latest "
+                          "when they started" % stale)
+    if unexpected:
+        violations.append("%d workers raised an error other than TurboFloatError"
+                          % len(unexpected))
+    if left_behind:
+        violations.append("%d leases left behind" % left_behind)
+
+    return {
+        "python": sys.version.split()[0],
+        "workers": workers,
+        "handles": handles,
+        "seats": seats,
+        "seconds": elapsed,
+        "setup_seconds": setup,
+        "operations": operations,
+        "errors": dict(errors),
+        "peak_leases": lib.peak_leases,
+        "callbacks_fired": storm.get("fired", 0),
+        "callbacks_delivered": sum(thread.callbacks for thread in threads),
+        "violations": violations,
+        "tracebacks": unexpected[:5],
+    }
+
+
+def _run_processes(processes, kwargs):
+    # Forked where possible, as a pre-forking server's workers would be.
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        context = multiprocessing.get_context()
+
+    seed = kwargs["seed"]
+    arguments = []
+    for number in range(processes):
+        process_kwargs = dict(kwargs)
+        if seed is not None:
+            process_kwargs["seed"] = seed + number
+        arguments.append(process_kwargs)
+
+    pool = context.Pool(processes)
+    try:
+        reports = pool.map(_run_process, arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+    operations = {}
+    for report in reports:
+        for name, stats in report["operations"].items():
+            merged = operations.setdefault(name, {"calls": 0, "ops_per_sec": 0.0, "max_ms": 0.0})
+            merged["calls"] += stats["calls"]
+            merged["ops_per_sec"] += stats["ops_per_sec"]
+            merged["max_ms"] = max(merged["max_ms"], stats["max_ms"])
+
+    errors = defaultdict(int)
+    for report in reports:
+        for error, n in report["errors"].items():
+            errors[error] += n
+
+    return {
+        "python": sys.version.split()[0],
+        "processes": reports,
+        "operations": operations,
+        "errors": dict(errors),
+        "violations": ["process %d: %s" % (number, violation)
+                       for number, report in enumerate(reports)
+                       for violation in report["violations"]],
+    }
+
+
+def _run_process(kwargs):
+    return run(**kwargs)
+
+
+def _fault(spec):
+    try:
+        name, code, rate = (spec.split(":") + ["1.0"])[:3]
+        return name, getattr(turbofloat.c_wrapper, code), float(rate)
+    except (ValueError, AttributeError):
+        raise argparse.ArgumentTypeError("expected FUNCTION:TF_E_CODE[:RATE], got %r" % spec)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m turbofloat.stress",
+                                     description="Stress test the TurboFloat binding.")
+    parser.add_argument("-w", "--workers", type=int, default=100,
+                        help="worker threads (default: %(default)s)")
+    parser.add_argument("-d", "--duration", type=float, default=5.0,
+                        help="seconds to run for (default: %(default)s)")
+    parser.add_argument("--seats", type=int, help="leases the server has (default: unlimited)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds each lease request and drop takes (default: %(default)s)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="up to this many more seconds per request (default: %(default)s)")
+    parser.add_argument("--fault", type=_fault, action="append", default=[],
+                        metavar="FUNCTION:TF_E_CODE[:RATE]",
+                        help="make a share of the calls to a function fail, e.g. "
+                             "TF_RequestLease:TF_E_INET_TIMEOUT:0.1")
+    parser.add_argument("--storm-rate", type=float, default=0.0,
+                        help="lease callbacks to fire per second (default: %(default)s)")
+    parser.add_argument("--expire-share", type=float, default=DEFAULT_EXPIRE_SHARE,
+                        help="share of the callbacks that expire a lease (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=1.0,
+                        help="acquire_lease() timeout (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="seed for the random choices")
+    parser.add_argument("--handles", type=int,
+                        help="handles the workers share (default: one per worker)")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="processes to run the workers in, each with as many "
+                             "(default: %(default)s)")
+    parser.add_argument("-o", "--output", help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    result = run(args.workers, args.duration, args.seats, args.latency, args.jitter,
+                 args.fault, args.storm_rate, args.expire_share, args.timeout, args.seed,
+                 args.handles, args.processes)
+    report = json.dumps(result, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+    return 1 if result["violations"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
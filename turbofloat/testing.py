@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Open Broadcast Systems Ltd. (https://www.obe.tv/)
+#
+# Author: Judah Rand <judahrand@obe.tv>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+An in-process stand-in for the TurboFloat library.
+
+FakeLibrary implements the TF_* functions used by c_wrapper with the same
+arguments and return codes as the native library, and its functions accept
+restype / argtypes / errcheck like ctypes function pointers do, so the
+TurboFloat class drives it exactly as it drives the real thing:
+
+    from turbofloat import TurboFloat
+    from turbofloat.testing import FakeLibrary, install
+
+    lib = install(FakeLibrary(features={b"seats": b"5"}))
+    tf = TurboFloat(b"TurboActivate.dat", b"guid")
+
+Latency and errors can be injected into any function, e.g. to make one
+request in ten fail as if the server couldn't be reached:
+
+    lib.set_latency("TF_RequestLease", 0.05, jitter=0.02)
+    lib.inject("TF_RequestLease", TF_E_INET, rate=0.1)
+"""
+
+import random
+import socket
+import threading
+import time
+from ctypes import _SimpleCData
+from datetime import datetime
+
+import turbofloat
+from turbofloat import c_wrapper
+from turbofloat.c_wrapper import *
+
+
+class _FakeFunction(object):
+
+    """Calls an implementation the way ctypes calls a foreign function."""
+
+    def __init__(self, name, impl, lib=None):
+        self.__name__ = name
+        self._impl = impl
+        self._lib = lib
+        self.restype = None
+        self.argtypes = None
+        self.errcheck = None
+
+    def __call__(self, *args):
+        lib = self._lib
+        if lib is not None and (lib._latency or lib._faults):
+            result = lib._fault(self.__name__)
+        else:
+            result = None
+
+        if result is None:
+            # Simple ctypes values reach the implementation as plain Python
+            # values, buffers and pointers are passed through.
+            result = self._impl(*[arg.value if isinstance(arg, _SimpleCData) else arg
+                                  for arg in args])
+
+        restype = self.restype
+        if restype is not None and not (isinstance(restype, type) and
+                                        issubclass(restype, _SimpleCData)):
+            result = restype(result)
+
+        if self.errcheck is not None:
+            result = self.errcheck(result, self, args)
+
+        return result
+
+
+def _value(arg):
+    """The Python value of a ctypes argument."""
+
+    return getattr(arg, "value", arg)
+
+
+class FakeLibrary(object):
+
+    """
+    Behaves like a TurboFloat library connected to a server with the given
+    features and number of seats (None for unlimited).
+
+    With connect, requesting a lease first opens a TCP connection to the saved
+    server and fails with TF_E_INET if it can't, or TF_E_INET_TIMEOUT after
+    connect seconds, so tests can start and stop local stand-in servers.
+    """
+
+    def __init__(self, features=None, seats=None, connect=None):
+        self.features = dict(features or {})
+        self.seats = seats
+        self.connect = connect
+        self.now = time.time
+
+        self._lock = threading.RLock()
+        self._dat_files = set()
+        self._guids = {}
+        self._servers = {}
+        self._callbacks = {}
+        self._leases = set()
+
+        # The most leases held at once.
+        self.peak_leases = 0
+
+        # Function name to (seconds, jitter) and to [code, rate, calls left].
+        self._latency = {}
+        self._faults = {}
+        self._random = random.Random()
+
+        for name in ("TF_PDetsFromPath", "TF_GetHandle", "TF_SaveServer", "TF_GetServer",
+                     "TF_SetLeaseCallback", "TF_SetLeaseCallbackEx", "TF_RequestLease",
+                     "TF_DropLease", "TF_HasLease", "TF_GetFeatureValue", "TF_IsDateValid",
+                     "TF_Cleanup"):
+            setattr(self, name, _FakeFunction(name, getattr(self, "_" + name), self))
+
+    #
+    # Test controls
+    #
+
+    def has_lease(self, handle):
+        return handle in self._leases
+
+    def fire(self, status, handle=None):
+        """Calls the lease callback of one handle, or of every handle that has a lease."""
+
+        with self._lock:
+            if status in (TF_CB_EXPIRED, TF_CB_EXPIRED_INET):
+                if handle is None:
+                    handles = set(self._leases)
+                    self._leases.clear()
+                else:
+                    handles = set([handle])
+                    self._leases.discard(handle)
+            else:
+                handles = set(self._leases) if handle is None else set([handle])
+
+            callbacks = [self._callbacks[h] for h in handles if h in self._callbacks]
+
+        for callback in callbacks:
+            callback(status, None)
+
+    def set_latency(self, name, seconds, jitter=0.0):
+        """
+        Makes every call to the function name take seconds plus up to jitter
+        seconds longer, as a call to the server would. Other calls aren't held up.
+        """
+
+        if seconds or jitter:
+            self._latency[name] = (seconds, jitter)
+        else:
+            self._latency.pop(name, None)
+
+    def inject(self, name, code, rate=1.0, count=None):
+        """
+        Makes calls to the function name return code instead, with probability
+        rate and for at most count calls (until clear_faults() if None). Replaces
+        any error already injected into name.
+        """
+
+        self._faults[name] = [code, rate, count]
+
+    def clear_faults(self):
+        """Removes the injected latency and errors."""
+
+        self._latency.clear()
+        self._faults.clear()
+
+    def seed(self, seed):
+        """Seeds the random choices of the latency jitter and injected errors."""
+
+        self._random.seed(seed)
+
+    def set_features(self, features):
+        """Replaces the features and tells every handle with a lease about it."""
+
+        with self._lock:
+            self.features = dict(features)
+
+        self.fire(TF_CB_FEATURES_CHANGED)
+
+    def _fault(self, name):
+        latency = self._latency.get(name)
+        if latency is not None:
+            seconds, jitter = latency
+            time.sleep(seconds + self._random.uniform(0, jitter) if jitter else seconds)
+
+        fault = self._faults.get(name)
+        if fault is None:
+            return None
+
+        with self._lock:
+            code, rate, count = fault
+            if count == 0 or (rate < 1.0 and self._random.random() >= rate):
+                return None
+            if count is not None:
+                fault[2] = count - 1
+
+        return code
+
+    #
+    # TF_* functions
+    #
+
+    def _TF_PDetsFromPath(self, path):
+        with self._lock:
+            path = _value(path)
+            if path in self._dat_files:
+                return TF_FAIL
+
+            self._dat_files.add(path)
+            return TF_OK
+
+    def _TF_GetHandle(self, guid):
+        with self._lock:
+            if not self._dat_files:
+                return 0
+
+            return self._guids.setdefault(_value(guid), len(self._guids) + 1)
+
+    def _valid_handle(self, handle):
+        return handle in self._guids.values()
+
+    def _TF_SaveServer(self, handle, host_address, port, flags):
+        with self._lock:
+            if not self._valid_handle(handle):
+                return TF_E_INVALID_HANDLE
+            if flags not in (TF_SYSTEM, TF_USER):
+                return TF_E_INVALID_FLAGS
+
+            self._servers[handle] = (_value(host_address), _value(port))
+            return TF_OK
+
+    def _TF_GetServer(self, handle, buf, buf_size, port):
+        with self._lock:
+            if not self._valid_handle(handle):
+                return TF_E_INVALID_HANDLE
+            if handle not in self._servers:
+                return TF_FAIL
+
+            host_address, server_port = self._servers[handle]
+            if len(host_address) + 1 > buf_size:
+                return TF_E_INSUFFICIENT_BUFFER
+
+            buf.value = host_address
+            if port:
+                # Either byref() or pointer() to a c_ushort.
+                target = port._obj if hasattr(port, "_obj") else port.contents
+                target.value = server_port
+
+            return TF_OK
+
+    def _TF_SetLeaseCallback(self, handle, callback):
+        return self._TF_SetLeaseCallbackEx(handle, lambda status, context: callback(status))
+
+    def _TF_SetLeaseCallbackEx(self, handle, callback, context=None):
+        with self._lock:
+            if not self._valid_handle(handle):
+                return TF_E_INVALID_HANDLE
+            if handle in self._leases:
+                return TF_E_LEASE_EXISTS
+
+            self._callbacks[handle] = callback
+            return TF_OK
+
+    def _TF_RequestLease(self, handle):
+        if self.connect and handle in self._servers:
+            code = self._connect(*self._servers[handle])
+            if code != TF_OK:
+                return code
+
+        with self._lock:
+            if not self._valid_handle(handle):
+                return TF_E_INVALID_HANDLE
+            if handle not in self._callbacks:
+                return TF_E_NO_CALLBACK
+            if handle not in self._servers:
+                return TF_E_SERVER
+            if handle in self._leases:
+                return TF_E_LEASE_EXISTS
+            if self.seats is not None and len(self._leases) >= self.seats:
+                return TF_E_NO_FREE_LEASES
+
+            self._leases.add(handle)
+            self.peak_leases = max(self.peak_leases, len(self._leases))
+            return TF_OK
+
+    def _connect(self, host_address, port):
+        if isinstance(host_address, bytes):
+            host_address = host_address.decode("utf-8")
+
+        try:
+            socket.create_connection((host_address, port), self.connect).close()
+        except socket.timeout:
+            return TF_E_INET_TIMEOUT
+        except OSError:
+            return TF_E_INET
+
+        return TF_OK
+
+    def _TF_DropLease(self, handle):
+        with self._lock:
+            if not self._valid_handle(handle):
+                return TF_E_INVALID_HANDLE
+            if handle not in self._leases:
+                return TF_E_NO_LEASE
+
+            self._leases.discard(handle)
+            return TF_OK
+
+    def _TF_HasLease(self, handle):
+        with self._lock:
+            if not self._valid_handle(handle):
+                return TF_E_INVALID_HANDLE
+
+            return TF_OK if handle in self._leases else TF_FAIL
+
+    def _TF_GetFeatureValue(self, handle, name, buf, buf_size):
+        with self._lock:
+            if not self._valid_handle(handle):
+                return TF_E_INVALID_HANDLE
+            if handle not in self._leases:
+                return TF_E_NO_LEASE
+
+            value = self.features.get(_value(name))
+
+            # Asking for the size of a missing feature returns zero.
+            if not buf:
+                return 0 if value is None else len(value) + 1
+
+            if value is None:
+                return TF_FAIL
+            if len(value) + 1 > buf_size:
+                return TF_E_INSUFFICIENT_BUFFER
+
+            buf.value = value
+            return TF_OK
+
+    def _TF_IsDateValid(self, handle, date, flags):
+        if not self._valid_handle(handle):
+            return TF_E_INVALID_HANDLE
+        if flags != TF_HAS_NOT_EXPIRED:
+            return TF_E_INVALID_FLAGS
+
+        date = _value(date)
+        if isinstance(date, bytes):
+            date = date.decode("utf-8")
+
+        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+            try:
+                expires = datetime.strptime(date, fmt)
+                break
+            except ValueError:
+                pass
+        else:
+            return TF_FAIL
+
+        seconds = (expires - datetime(1970, 1, 1)).total_seconds()
+        return TF_OK if seconds > self.now() else TF_FAIL
+
+    def _TF_Cleanup(self):
+        with self._lock:
+            self._dat_files.clear()
+            self._guids.clear()
+            self._servers.clear()
+            self._callbacks.clear()
+            self._leases.clear()
+
+            return TF_OK
+
+
+def install(lib, library_folder=""):
+    """
+    Makes TurboFloat objects created with library_folder use lib instead of
+    loading the TurboFloat library. Returns lib.
+    """
+
+    with c_wrapper._libraries_lock:
+        c_wrapper._set_prototypes(lib)
+        c_wrapper._libraries[c_wrapper._library_key(library_folder)] = lib
+        c_wrapper._libraries_by_path.clear()
+
+    return lib
+
+
+def uninstall(library_folder=""):
+    """Undoes install()."""
+
+    with c_wrapper._libraries_lock:
+        lib = c_wrapper._libraries.pop(c_wrapper._library_key(library_folder), None)
+        c_wrapper._libraries_by_path.clear()
+
+    if lib is not None:
+        turbofloat._forget_handles(lib)